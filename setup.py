@@ -22,9 +22,15 @@ setup(
     url='https://github.com/blixt/py-starbound',
     author='Blixt',
     author_email='me@blixt.nyc',
-    # Shouldn't have any deps other than Python itself
+    # Shouldn't have any deps other than Python itself, except for the
+    # `concurrent.futures` backport that the threaded tools need on 2.x.
         install_requires=[
+            'futures; python_version < "3"',
     ],
+    # NumPy is only needed for the array based tile APIs.
+    extras_require={
+        'numpy': ['numpy'],
+    },
     # https://pypi.python.org/pypi?%3Aaction=list_classifiers
     classifiers=[
             'Development Status :: 5 - Production/Stable',
@@ -45,6 +51,9 @@ setup(
                 'pystarbound-region = starbound.cliregion:main',
                 'pystarbound-repair = starbound.clirepair:main',
                 'pystarbound-export = starbound.cliexport:main',
+                'pystarbound-diff = starbound.clidiff:main',
+                'pystarbound-render = starbound.clirender:main',
+                'pystarbound-scan = starbound.cliscan:main',
             ],
     },
 )
@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 
-from collections import namedtuple
+from collections import deque, namedtuple
 import hashlib
 import io
+import multiprocessing
 import struct
 import zlib
 
 from . import sbon
+from .assetdb import AssetDatabase, AssetDirectory
 from .btreedb5 import BTreeDB5
+from .entityindex import EntityIndex, EntityRecord, entity_position
 from .sbasset6 import SBAsset6
+from .worlddiff import WorldDiff, diff_worlds
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __version__ = '1.0.0'
 
@@ -46,8 +55,7 @@ class CelestialChunks(BTreeDB5):
         key = hashlib.sha256(key.encode('utf-8')).digest()
         data = super(CelestialChunks, self).get(key)
         data = zlib.decompress(data)
-        stream = io.BytesIO(data)
-        return read_versioned_json(stream)
+        return loads_versioned_json(data)[0]
 
     def read_header(self):
         super(CelestialChunks, self).read_header()
@@ -77,35 +85,126 @@ Tile = namedtuple('Tile', [
 ])
 
 
+# The values of tiles in regions that haven't been generated yet. Material
+# and mod IDs are read as signed values, so 65535 ("null") becomes -1.
+NOT_GENERATED_TILE = Tile(
+    foreground_material=-1,
+    foreground_hue_shift=0,
+    foreground_variant=0,
+    foreground_mod=-1,
+    foreground_mod_hue_shift=0,
+    background_material=-1,
+    background_hue_shift=0,
+    background_variant=0,
+    background_mod=-1,
+    background_mod_hue_shift=0,
+    liquid=0,
+    liquid_level=0.0,
+    liquid_pressure=0.0,
+    liquid_infinite=0,
+    collision=0,
+    dungeon_id=65535,
+    biome=0,
+    biome_2=0,
+    indestructible=False,
+)
+
+
+# NumPy equivalent of the struct format used by `World.read_tile`.
+if numpy:
+    TILE_DTYPE = numpy.dtype({
+        'names': Tile._fields,
+        'formats': [
+            '>i2', 'u1', 'u1', '>i2', 'u1',
+            '>i2', 'u1', 'u1', '>i2', 'u1',
+            'u1', '>f4', '>f4', 'u1',
+            'u1', '>u2', 'u1', 'u1', '?',
+        ],
+        'itemsize': 31,
+    })
+else:
+    TILE_DTYPE = None
+
+
 VersionedJSON = namedtuple('VersionedJSON', ['name', 'version', 'data'])
 
 
 class World(BTreeDB5):
     @lazyproperty
     def info(self):
-        if not hasattr(self, 'metadata'):
-            self.read_metadata()
-        return WorldInfo(self.metadata)
+        if hasattr(self, 'metadata'):
+            return WorldInfo(self.metadata)
+        # Only decode the parts of the metadata that are actually used.
+        name, _, metadata = loads_versioned_json(self.get(0, 0, 0), 8, lazy=True)[0]
+        assert name == 'WorldMetadata', 'Invalid world data'
+        return WorldInfo(metadata)
 
     def get(self, layer, x, y):
         # World keys are based on a layer followed by X and Y coordinates.
         data = super(World, self).get(struct.pack('>BHH', layer, x, y))
         return zlib.decompress(data)
 
+    def get_many(self, layer, coords):
+        """
+        Returns a dict mapping `(x, y)` to the decompressed data for every
+        region in `coords` that exists in the given layer. Missing regions are
+        left out.
+        """
+        keys = dict((struct.pack('>BHH', layer, x, y), (x, y)) for x, y in coords)
+        values = super(World, self).get_many(keys)
+        return dict((keys[key], zlib.decompress(data)) for key, data in values.items())
+
+    def put(self, layer, x, y, data):
+        """
+        Stages new (uncompressed) data for the given layer and coordinates.
+        Call `commit` to write it to the world file.
+        """
+        super(World, self).put(struct.pack('>BHH', layer, x, y), zlib.compress(data))
+
+    def delete(self, layer, x, y):
+        super(World, self).delete(struct.pack('>BHH', layer, x, y))
+
+    def commit(self):
+        super(World, self).commit()
+        # Entities may have been added, removed or moved.
+        del self._entity_to_region_map
+
     def get_all_regions_with_tiles(self):
         """
         Generator which yields a set of (rx, ry) tuples which describe
         all regions for which the world has tile data
         """
-        for key in self.get_all_keys():
-            (layer, rx, ry) = struct.unpack('>BHH', key)
-            if layer == 1:
-                yield (rx, ry)
+        for key in self.prefix_keys(b'\x01'):
+            (_, rx, ry) = struct.unpack('>BHH', key)
+            yield (rx, ry)
+
+    def build_entity_index(self):
+        """
+        Scans all entities in the world once and returns an `EntityIndex`
+        with their type, name, unique id and position. Only those fields
+        are decoded.
+        """
+        records = []
+        for key, data in self.prefix_items(b'\x02'):
+            _, rx, ry = struct.unpack('>BHH', key)
+            entities = self.read_entities(zlib.decompress(data), lazy=True)
+            for index, entity in enumerate(entities):
+                data = entity.data
+                name = data.get('name')
+                if not isinstance(name, sbon._str_type):
+                    name = None
+                records.append(EntityRecord(entity.name, name, data.get('uniqueId'),
+                                            entity_position(data), (rx, ry), index))
+        return EntityIndex(records)
 
     def get_entities(self, x, y):
-        stream = io.BytesIO(self.get(2, x, y))
-        count = sbon.read_varint(stream)
-        return [read_versioned_json(stream) for _ in range(count)]
+        return self.read_entities(self.get(2, x, y))
+
+    def get_entity(self, record):
+        """
+        Returns the full entity for a record from an `EntityIndex`.
+        """
+        return self.get_entities(*record.region)[record.index]
 
     def get_entity_uuid_coords(self, uuid):
         """
@@ -114,23 +213,106 @@ class World(BTreeDB5):
         """
         if uuid in self._entity_to_region_map:
             coords = self._entity_to_region_map[uuid]
-            entities = self.get_entities(*coords)
+            # Only the two fields we need are decoded for each entity.
+            entities = self.read_entities(self.get(2, *coords), lazy=True)
             for entity in entities:
                 if 'uniqueId' in entity.data and entity.data['uniqueId'] == uuid:
                     return tuple(entity.data['tilePosition'])
         return None
 
+    def load_entity_index(self, path=None, index_path=None):
+        """
+        Like `load_key_index`, but for the `EntityIndex` of the world, which
+        is stored next to the world with `.pyent` appended to its name.
+        """
+        return self._load_sidecar(EntityIndex, '.pyent', path, index_path,
+                                  self.build_entity_index)
+
     def get_tiles(self, x, y):
-        stream = io.BytesIO(self.get(1, x, y))
-        # TODO: Figure out what this means.
-        unknown = stream.read(3)
-        # There are 1024 (32x32) tiles in a region.
-        return [self.read_tile(stream) for _ in range(1024)]
+        return self.read_tiles(io.BytesIO(self.get(1, x, y)))
+
+    def get_tiles_array(self, x, y):
+        """
+        Returns the tiles of a region as a 32×32 NumPy structured array with
+        the same fields as `Tile`, indexed as `array[y, x]`. The array is
+        decoded without copying, so it's read-only. Requires NumPy.
+        """
+        return self.read_tiles_array(self.get(1, x, y))
+
+    def get_tile_grid(self, field=None, bbox=None):
+        """
+        Returns a NumPy array of the tiles in the whole world, or in the
+        `(min_x, min_y, max_x, max_y)` tile bounding box if `bbox` is given
+        (the max coordinates are exclusive), indexed as `grid[y, x]` relative
+        to the bounding box. If `field` is the name of a `Tile` field, the
+        grid only contains that value, otherwise it's a structured array with
+        all fields. Regions that don't exist are filled with the values of
+        `NOT_GENERATED_TILE`. Requires NumPy.
+        """
+        if numpy is None:
+            raise ImportError('NumPy is required for get_tile_grid')
+        if not hasattr(self, 'width'):
+            self.read_metadata()
+        min_x, min_y, max_x, max_y = bbox or (0, 0, self.width, self.height)
+        min_x, min_y = max(min_x, 0), max(min_y, 0)
+        max_x, max_y = min(max_x, self.width), min(max_y, self.height)
+        shape = (max(max_y - min_y, 0), max(max_x - min_x, 0))
+        if field is None:
+            grid = numpy.empty(shape, dtype=TILE_DTYPE)
+            grid[...] = tuple(NOT_GENERATED_TILE)
+        else:
+            grid = numpy.empty(shape, dtype=TILE_DTYPE[field])
+            grid.fill(getattr(NOT_GENERATED_TILE, field))
+        if not grid.size:
+            return grid
+        min_ry, max_ry = min_y // 32, (max_y - 1) // 32
+        for rx in range(min_x // 32, (max_x - 1) // 32 + 1):
+            # Keys are ordered by X before Y, so each column is one scan.
+            start = struct.pack('>BHH', 1, rx, min_ry)
+            end = struct.pack('>BHH', 1, rx, max_ry + 1)
+            for key, data in self.items(start, end):
+                _, _, ry = struct.unpack('>BHH', key)
+                tiles = self.read_tiles_array(zlib.decompress(data))
+                if field is not None:
+                    tiles = tiles[field]
+                # Copy the part of the region that overlaps the bounding box.
+                x0, y0 = max(rx * 32, min_x), max(ry * 32, min_y)
+                x1, y1 = min(rx * 32 + 32, max_x), min(ry * 32 + 32, max_y)
+                grid[y0 - min_y:y1 - min_y, x0 - min_x:x1 - min_x] = \
+                    tiles[y0 - ry * 32:y1 - ry * 32, x0 - rx * 32:x1 - rx * 32]
+        return grid
+
+    def iter_regions(self, layer, workers=None, executor='thread', ordered=True):
+        """
+        Generator which yields `((rx, ry), value)` for every region in the
+        given layer. The compressed values are read sequentially and then
+        decompressed and decoded in a pool of `workers` threads or processes
+        (depending on `executor`). Tiles (layer 1) and entities (layer 2) are
+        decoded like `get_tiles` and `get_entities`, other layers are yielded
+        as decompressed data. Results are yielded in key order, unless
+        `ordered` is false, in which case they're yielded as they complete.
+        Requires `concurrent.futures` (the `futures` backport on Python 2).
+        """
+        def regions():
+            for key, data in self.prefix_items(struct.pack('>B', layer)):
+                if executor == 'process':
+                    # Memoryviews can't be sent to other processes.
+                    data = sbon._bytes(data)
+                yield layer, key, data
+        return _imap_bounded(_decode_region, regions(), workers, executor, ordered)
 
     def read_header(self):
         super(World, self).read_header()
         assert self.name == 'World4', 'Not a World4 file'
 
+    def _key_index_extras(self):
+        # Store the entity map so that it doesn't need to be rebuilt by every
+        # process that opens the world.
+        del self._entity_to_region_map
+        entities = dict((uuid, list(coords)) for uuid, coords
+                        in self._entity_to_region_map.items())
+        return {'entities': entities}
+
     def read_metadata(self):
         # World metadata is held at a special layer/x/y combination.
         stream = io.BytesIO(self.get(0, 0, 0))
@@ -140,11 +322,38 @@ class World(BTreeDB5):
         self.metadata = data
         self.metadata_version = version
 
+    @classmethod
+    def read_entities(cls, data, lazy=False):
+        # Convert the data once instead of in every call below (the sbon
+        # functions copy anything but a bytearray on Python 2).
+        data = sbon._indexable(data)
+        count, offset = sbon.loads_varint(data)
+        entities = []
+        for _ in range(count):
+            entity, offset = loads_versioned_json(data, offset, lazy)
+            entities.append(entity)
+        return entities
+
     @classmethod
     def read_tile(cls, stream):
         values = struct.unpack('>hBBhBhBBhBBffBBHBB?x', stream.read(31))
         return Tile(*values)
 
+    @classmethod
+    def read_tiles(cls, stream):
+        # TODO: Figure out what this means.
+        unknown = stream.read(3)
+        # There are 1024 (32x32) tiles in a region.
+        return [cls.read_tile(stream) for _ in range(1024)]
+
+    @classmethod
+    def read_tiles_array(cls, data):
+        if numpy is None:
+            raise ImportError('NumPy is required for reading tiles as arrays')
+        # Skip the 3 unknown bytes at the start, same as `get_tiles`.
+        tiles = numpy.frombuffer(data, dtype=TILE_DTYPE, count=1024, offset=3)
+        return tiles.reshape(32, 32)
+
     @lazyproperty
     def _entity_to_region_map(self):
         """
@@ -153,21 +362,75 @@ class World(BTreeDB5):
         entity can be found. This can be used to easily locate particular
         entities inside the world.
         """
+        if self.key_index is not None and 'entities' in self.key_index.extras:
+            return dict((uuid, tuple(coords)) for uuid, coords
+                        in self.key_index.extras['entities'].items())
         entity_to_region = {}
-        for key in self.get_all_keys():
-            layer, rx, ry = struct.unpack('>BHH', key)
-            if layer != 4:
-                continue
-            stream = io.BytesIO(self.get(layer, rx, ry))
-            num_entities = sbon.read_varint(stream)
+        for key, data in self.prefix_items(b'\x04'):
+            _, rx, ry = struct.unpack('>BHH', key)
+            data = sbon._indexable(zlib.decompress(data))
+            num_entities, offset = sbon.loads_varint(data)
             for _ in range(num_entities):
-                uuid = sbon.read_string(stream)
+                uuid, offset = sbon.loads_string(data, offset)
                 if uuid in entity_to_region:
                     raise ValueError('Duplicate UUID {}'.format(uuid))
                 entity_to_region[uuid] = (rx, ry)
         return entity_to_region
 
 
+def _imap_bounded(function, arguments, workers=None, executor='thread',
+                  ordered=True, max_pending=None):
+    # Generator which calls `function(*args)` for every tuple in `arguments`
+    # in a pool of `workers` threads or processes and yields the results,
+    # either in order or as they complete. No more than `max_pending` calls
+    # (by default four per worker) are submitted ahead of the results that
+    # have been taken, so that memory use stays bounded.
+    import concurrent.futures
+    if executor == 'process':
+        pool_class = concurrent.futures.ProcessPoolExecutor
+    elif executor == 'thread':
+        pool_class = concurrent.futures.ThreadPoolExecutor
+    else:
+        raise ValueError('Unknown executor {!r}'.format(executor))
+    workers = workers or multiprocessing.cpu_count()
+    max_pending = max_pending or workers * 4
+    pool = pool_class(workers)
+    pending = deque()
+
+    def next_result():
+        if ordered:
+            return pending.popleft().result()
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        future = done.pop()
+        pending.remove(future)
+        return future.result()
+
+    try:
+        for args in arguments:
+            pending.append(pool.submit(function, *args))
+            if len(pending) >= max_pending:
+                yield next_result()
+        while pending:
+            yield next_result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def _decode_region(layer, key, data):
+    # Used by `World.iter_regions`; needs to be a module level function so
+    # that it can be sent to worker processes.
+    _, rx, ry = struct.unpack('>BHH', key)
+    data = zlib.decompress(data)
+    if layer == 1:
+        data = World.read_tiles(io.BytesIO(data))
+    elif layer == 2:
+        data = World.read_entities(data)
+    return (rx, ry), data
+
+
 class WorldInfo(object):
     """
     Convenience class to provide some information about a World without having
@@ -286,7 +549,35 @@ def read_sbvj01(stream):
     return read_versioned_json(stream)
 
 
+def loads_versioned_json(buf, offset=0, lazy=False):
+    """
+    Decodes versioned JSON starting at `offset` in a bytes-like object.
+    Returns a `(VersionedJSON, end_offset)` tuple. If `lazy` is true, maps
+    and lists in the data are decoded on demand (see `sbon.loads_lazy`).
+    """
+    buf = sbon._indexable(buf)
+    name, offset = sbon.loads_string(buf, offset)
+    # The object only has a version if the following bool is true.
+    if buf[offset:offset + 1] == b'\x00':
+        version = None
+        offset += 1
+    else:
+        version, = struct.unpack_from('>i', buf, offset + 1)
+        offset += 5
+    if lazy:
+        data, offset = sbon.loads_lazy(buf, offset)
+    else:
+        data, offset = sbon.loads(buf, offset)
+    return VersionedJSON(name, version, data), offset
+
+
 def read_versioned_json(stream):
+    if hasattr(stream, 'getbuffer'):
+        # In-memory streams can be decoded straight from their buffer.
+        with stream.getbuffer() as buf:
+            vj, offset = loads_versioned_json(buf, stream.tell())
+        stream.seek(offset)
+        return vj
     name = sbon.read_string(stream)
     # The object only has a version if the following bool is true.
     if stream.read(1) == b'\x00':
@@ -302,10 +593,16 @@ def write_sbvj01(stream, vj):
     write_versioned_json(stream, vj)
 
 
-def write_versioned_json(stream, vj):
-    sbon.write_string(stream, vj.name)
+def dumps_versioned_json(vj):
+    """
+    Encodes a `VersionedJSON` and returns the resulting bytes.
+    """
     if vj.version is None:
-        stream.write(struct.pack('>b', 0))
+        version = struct.pack('>b', 0)
     else:
-        stream.write(struct.pack('>bi', 1, vj.version))
-    sbon.write_dynamic(stream, vj.data)
+        version = struct.pack('>bi', 1, vj.version)
+    return b''.join([sbon.dumps_string(vj.name), version, sbon.dumps(vj.data)])
+
+
+def write_versioned_json(stream, vj):
+    stream.write(dumps_versioned_json(vj))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio wrappers for worlds and asset packages (Python 3.5+ only).
+
+The blocking reads, decompression and decoding all happen in a bounded
+thread pool, and concurrent requests for the same key share a single read.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import io
+
+
+class _AsyncReader(object):
+    def __init__(self, executor=None, max_workers=4):
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+            self._owns_executor = True
+        else:
+            self._owns_executor = False
+        self.executor = executor
+        self._in_flight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
+
+    async def _run(self, key, func, *args):
+        # Requests for a key that is already being read wait for that read.
+        future = self._in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self.executor, functools.partial(func, *args))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Don't let one cancelled caller cancel the read for everyone else.
+        return await asyncio.shield(future)
+
+
+class AsyncSBAsset6(_AsyncReader):
+    """
+    Wraps an `SBAsset6` (whose index must already have been read) for use
+    from asyncio code.
+    """
+
+    def __init__(self, package, executor=None, max_workers=4):
+        super(AsyncSBAsset6, self).__init__(executor, max_workers)
+        self.package = package
+
+    async def get(self, path):
+        return await self._run(path, self.package.get, path)
+
+
+class AsyncWorld(_AsyncReader):
+    """
+    Wraps a `World` for use from asyncio code. All methods return the same
+    values as their `World` counterparts, but callers that were waiting for
+    the same region get the same object, so don't modify it.
+    """
+
+    def __init__(self, world, executor=None, max_workers=4):
+        super(AsyncWorld, self).__init__(executor, max_workers)
+        self.world = world
+
+    async def get(self, layer, x, y):
+        return await self._run(('get', layer, x, y), self.world.get, layer, x, y)
+
+    async def get_entities(self, x, y):
+        return await self._run(('entities', x, y), self._get_entities, x, y)
+
+    async def get_tiles(self, x, y):
+        return await self._run(('tiles', x, y), self._get_tiles, x, y)
+
+    async def get_tiles_array(self, x, y):
+        return await self._run(('tiles_array', x, y), self._get_tiles_array, x, y)
+
+    def _get_entities(self, x, y):
+        return self.world.read_entities(self.world.get(2, x, y))
+
+    def _get_tiles(self, x, y):
+        return self.world.read_tiles(io.BytesIO(self.world.get(1, x, y)))
+
+    def _get_tiles_array(self, x, y):
+        return self.world.read_tiles_array(self.world.get(1, x, y))
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import copy
+import json
+import os
+import os.path
+import posixpath
+import re
+
+from starbound import sbon
+from starbound.cache import LRUCache
+from starbound.sbasset6 import IndexEntry, SBAsset6
+
+
+try:
+    _str_type = basestring
+except NameError:
+    _str_type = str
+
+
+# Matches strings (so they can be kept as they are) and comments.
+_COMMENT_RE = re.compile(r'"(?:\\.|[^"\\])*"|//[^\n]*|/\*.*?\*/', re.DOTALL)
+
+
+class PatchTestFailed(Exception):
+    pass
+
+
+def apply_json_patch(document, patch, errors=None):
+    """
+    Applies a JSON patch to a document and returns the patched document. Like
+    in Starbound, the patch may also be a list of patches, and a patch is
+    skipped (leaving the document as it was) if one of its `test` operations
+    fails. Patches with operations that can't be applied (e.g., adding to a
+    path whose parent doesn't exist) are skipped too, and if `errors` is a
+    list, the exception for each of them is appended to it. The document
+    passed in is never modified.
+    """
+    if patch and all(isinstance(operations, list) for operations in patch):
+        patches = patch
+    else:
+        patches = [patch]
+    for operations in patches:
+        try:
+            document = _apply_operations(copy.deepcopy(document), operations)
+        except PatchTestFailed:
+            pass
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            if errors is not None:
+                errors.append(e)
+    return document
+
+
+def parse_json(data):
+    """
+    Parses JSON which may contain comments, as Starbound's asset files do.
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = sbon._bytes(data).decode('utf-8-sig')
+    return json.loads(_COMMENT_RE.sub(_keep_strings, data))
+
+
+class AssetDirectory(object):
+    """
+    An unpacked asset source (e.g., a mod folder) which can be mounted in an
+    `AssetDatabase` alongside `SBAsset6` packages. Like in packages, paths
+    are absolute and lowercased.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.metadata = {}
+        self.index = {}
+        # Maps the lowercased asset paths to the actual files on disk.
+        self.files = {}
+        for dir_path, _, filenames in os.walk(path):
+            for filename in filenames:
+                file_path = os.path.join(dir_path, filename)
+                relative = os.path.relpath(file_path, path).replace(os.sep, '/')
+                asset_path = '/' + relative.lower()
+                self.files[asset_path] = file_path
+                self.index[asset_path] = IndexEntry(0, os.path.getsize(file_path))
+
+    def get(self, path):
+        with open(self.files[path.lower()], 'rb') as f:
+            return f.read()
+
+
+class AssetDatabase(object):
+    """
+    A layered view of multiple asset sources (`SBAsset6` packages and
+    `AssetDirectory` folders). Files in sources with a higher priority
+    override those in sources with a lower priority, and sources with the
+    same priority override the ones mounted before them. All sources are
+    merged into a single index when they're mounted, so looking up a path
+    doesn't depend on the number of sources.
+    """
+
+    def __init__(self, json_cache_size=1024):
+        self.sources = []
+        # Maps each path to a `(source number, offset, length)` tuple.
+        self.index = {}
+        # Parsed (and patched) JSON assets, see `get_json`.
+        self.json_cache = LRUCache(json_cache_size)
+        # `(patch path, source, exception)` for patches that failed to apply.
+        self.patch_errors = []
+        self._priorities = []
+        self._extensions = {}
+        self._patches = {}
+        self._sorted_paths = None
+
+    def __contains__(self, path):
+        return path.lower() in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, path):
+        path = path.lower()
+        return self._read(self.index[path][0], path)
+
+    def get_json(self, path):
+        """
+        Returns the parsed JSON of the file at the given path, with the
+        `.patch` files for it from all sources applied in priority order.
+        As in Starbound, a broken patch doesn't stop the others from being
+        applied; it's skipped and added to `patch_errors` instead. Results
+        are cached, so treat them as read-only.
+        """
+        path = path.lower()
+        number = self.index[path][0]
+        key = (self.sources[number], path)
+        document = self.json_cache.get(key)
+        if document is None:
+            document = parse_json(self.get(path))
+            patch_path = path + '.patch'
+            for patch_number in self._patches.get(path, ()):
+                errors = []
+                try:
+                    patch = parse_json(self._read(patch_number, patch_path))
+                    document = apply_json_patch(document, patch, errors)
+                except ValueError as e:
+                    errors.append(e)
+                for error in errors:
+                    self.patch_errors.append((patch_path, self.sources[patch_number], error))
+            self.json_cache.put(key, document)
+        return document
+
+    def get_source(self, path):
+        """
+        Returns the source that the file at the given path is read from.
+        """
+        return self.sources[self.index[path.lower()][0]]
+
+    def list_files(self, directory=None, extension=None):
+        """
+        Returns a sorted list of the paths of all files in the given
+        directory (including subdirectories) and/or with the given extension
+        (e.g., `'.item'`).
+        """
+        if extension is not None:
+            extension = '.' + extension.lstrip('.').lower()
+            paths = sorted(self._extensions.get(extension, ()))
+        else:
+            if self._sorted_paths is None:
+                self._sorted_paths = sorted(self.index)
+            paths = self._sorted_paths
+        if directory is None:
+            return list(paths)
+        prefix = directory.lower().rstrip('/') + '/'
+        start = bisect.bisect_left(paths, prefix)
+        end = start
+        while end < len(paths) and paths[end].startswith(prefix):
+            end += 1
+        return paths[start:end]
+
+    def mount(self, source, priority=None):
+        """
+        Adds an `SBAsset6` package, an `AssetDirectory`, or the path of a
+        directory to the database. The priority defaults to the `priority`
+        value of the package's metadata, or 0. Returns the source number.
+        """
+        if isinstance(source, _str_type):
+            source = AssetDirectory(source)
+        if isinstance(source, SBAsset6) and not hasattr(source, 'index'):
+            source.read_index()
+        if priority is None:
+            priority = source.metadata.get('priority', 0)
+        number = len(self.sources)
+        self.sources.append(source)
+        self._priorities.append(priority)
+        index = self.index
+        priorities = self._priorities
+        for path, entry in source.index.items():
+            current = index.get(path)
+            if current is not None and priorities[current[0]] > priority:
+                continue
+            if current is None:
+                extension = posixpath.splitext(path)[1]
+                self._extensions.setdefault(extension, set()).add(path)
+            index[path] = (number, entry.offset, entry.length)
+        # Patches from every source apply, not just from the one that wins.
+        for path in source.index:
+            if path.endswith('.patch'):
+                numbers = self._patches.setdefault(path[:-6], [])
+                numbers.append(number)
+                numbers.sort(key=lambda n: (priorities[n], n))
+        self._sorted_paths = None
+        self.json_cache.clear()
+        return number
+
+    def _read(self, number, path):
+        source = self.sources[number]
+        if isinstance(source, SBAsset6):
+            entry = source.index[path]
+            data = source.read_at(entry.offset, entry.length)
+            return data.tobytes() if isinstance(data, memoryview) else data
+        return source.get(path)
+
+
+def _apply_operations(document, operations):
+    for operation in operations:
+        op = operation['op']
+        path = _parse_pointer(operation['path'])
+        if op == 'test':
+            try:
+                value = _resolve(document, path)
+                passed = 'value' not in operation or value == operation['value']
+            except (KeyError, IndexError, TypeError, ValueError):
+                passed = False
+            if passed == bool(operation.get('inverse', False)):
+                raise PatchTestFailed(operation['path'])
+        elif op == 'add':
+            document = _add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'remove':
+            _remove(document, path)
+        elif op == 'replace':
+            _remove(document, path)
+            document = _add(document, path, copy.deepcopy(operation['value']))
+        elif op == 'move':
+            source = _parse_pointer(operation['from'])
+            value = _resolve(document, source)
+            _remove(document, source)
+            document = _add(document, path, value)
+        elif op == 'copy':
+            value = copy.deepcopy(_resolve(document, _parse_pointer(operation['from'])))
+            document = _add(document, path, value)
+        else:
+            raise ValueError('Unknown patch operation {!r}'.format(op))
+    return document
+
+
+def _add(document, path, value):
+    if not path:
+        return value
+    parent = _resolve(document, path[:-1])
+    key = path[-1]
+    if isinstance(parent, list):
+        if key == '-':
+            parent.append(value)
+        else:
+            parent.insert(int(key), value)
+    else:
+        parent[key] = value
+    return document
+
+
+def _keep_strings(match):
+    text = match.group(0)
+    return text if text.startswith('"') else ' '
+
+
+def _parse_pointer(pointer):
+    if not pointer:
+        return []
+    return [part.replace('~1', '/').replace('~0', '~') for part in pointer.split('/')[1:]]
+
+
+def _remove(document, path):
+    parent = _resolve(document, path[:-1])
+    key = path[-1]
+    if isinstance(parent, list):
+        del parent[int(key)]
+    else:
+        del parent[key]
+
+
+def _resolve(document, path):
+    for key in path:
+        if isinstance(document, list):
+            document = document[int(key)]
+        else:
+            document = document[key]
+    return document
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import binascii
-import io
+import bisect
+from collections import namedtuple
+import os
 import struct
+import threading
 
 from starbound import sbon
+from starbound.cache import LRUCache
+from starbound.sbon import _bytes, _indexable
 
 
 # Override range with xrange when running Python 2.x.
@@ -16,99 +21,318 @@ except:
 
 HEADER = '>8si16si?ixxxxii?ixxxxii?445x'
 HEADER_SIZE = struct.calcsize(HEADER)
+# Each root has its own free list head, device size, root block and leaf flag,
+# stored after a flag that selects which of the two roots is in use.
+ROOT_INFO = struct.Struct('>iqi?')
+ROOT_INFO_OFFSETS = (33, 33 + ROOT_INFO.size)
+ROOT_SELECTOR_OFFSET = 32
 # Constants for the different block types.
 FREE = b'FF'
 INDEX = b'II'
 LEAF = b'LL'
 
 
+IndexNode = namedtuple('IndexNode', ['level', 'keys', 'children'])
+
+
+class BlockCache(LRUCache):
+    """
+    A size-bounded LRU cache of BTreeDB5 blocks. Index blocks are stored
+    decoded (as `IndexNode` tuples) and leaf blocks are stored as raw bytes.
+    Pass an instance to `BTreeDB5` to avoid re-reading hot blocks, such as
+    the upper levels of the index, for every lookup. One cache can be shared
+    by several databases, since each database keeps its blocks apart from
+    those of the others.
+    """
+
+    def __init__(self, max_blocks=4096):
+        super(BlockCache, self).__init__(max_blocks)
+
+
 class BTreeDB5(object):
-    def __init__(self, stream):
+    def __init__(self, stream, cache=None):
         self.stream = stream
+        self.cache = cache
+        self.key_index = None
+        # Changes staged by `put` and `delete` (`None` means deleted).
+        self.pending = {}
+        # If the stream supports the buffer protocol (e.g., an mmap), blocks
+        # are sliced directly out of it instead of being seeked and read. A
+        # new view is made for every read rather than keeping one around, so
+        # that the mmap can still be closed while this object exists.
+        try:
+            memoryview(stream)
+            self.is_buffer = True
+        except TypeError:
+            self.is_buffer = False
+        # Otherwise `os.pread` is used if the stream is a real file, so that
+        # reads never depend on (or move) the stream position.
+        self._fileno = None
+        if not self.is_buffer and hasattr(os, 'pread'):
+            try:
+                self._fileno = stream.fileno()
+            except (AttributeError, IOError, ValueError):
+                pass
+        # Guards the stream position when neither of the above is possible.
+        self._lock = threading.Lock()
 
     def get(self, key):
+        """
+        Returns the value for the given key. If the database was opened from
+        a buffer, the value is a memoryview into it unless it spans multiple
+        blocks, otherwise it's a bytes object.
+        """
         if not hasattr(self, 'key_size'):
             self.read_header()
         assert len(key) == self.key_size, 'Invalid key length'
+        if self.key_index is not None:
+            # Go straight to the value without traversing the tree.
+            try:
+                block, offset, length = self.key_index.locations[key]
+            except KeyError:
+                raise KeyError(binascii.hexlify(key))
+            reader = LeafReader(self, self.read_node(block), block)
+            reader.offset = offset
+            return reader.read(length)
         # Traverse the B-tree until we reach a leaf.
-        offset = HEADER_SIZE + self.block_size * self.root_block
-        entry_size = self.key_size + 4
-        s = self.stream
+        block = self.root_block
         while True:
-            s.seek(offset)
-            block_type = s.read(2)
-            if block_type != INDEX:
+            node = self.read_node(block)
+            if isinstance(node, IndexNode):
+                block = node.children[bisect.bisect_right(node.keys, key)]
+            elif node[:2] == INDEX:
+                block = self._search_index(node, key)
+            else:
                 break
-            # Read the index header and scan for the closest key.
-            lo, (_, hi, block) = 0, struct.unpack('>Bii', s.read(9))
-            offset += 11
-            while lo < hi:
-                mid = (lo + hi) // 2
-                s.seek(offset + entry_size * mid)
-                if key < s.read(self.key_size):
-                    hi = mid
-                else:
-                    lo = mid + 1
-            if lo > 0:
-                s.seek(offset + entry_size * (lo - 1) + self.key_size)
-                block, = struct.unpack('>i', s.read(4))
-            offset = HEADER_SIZE + self.block_size * block
-        assert block_type == LEAF, 'Did not reach a leaf'
+        assert node[:2] == LEAF, 'Did not reach a leaf'
         # Scan leaves for the key, then read the data.
-        reader = LeafReader(self)
+        reader = LeafReader(self, node)
         num_keys, = struct.unpack('>i', reader.read(4))
         for i in range(num_keys):
             cur_key = reader.read(self.key_size)
-            length = sbon.read_varint(reader)
+            length = reader.read_varint()
             if key == cur_key:
                 return reader.read(length)
             reader.seek(length, 1)
         # None of the keys in the leaf node matched.
         raise KeyError(binascii.hexlify(key))
 
+    def get_many(self, keys):
+        """
+        Returns a dict with the values for all of the given keys that exist in
+        the database; missing keys are left out. The keys are looked up in
+        sorted order so that every index block and leaf on the way is only
+        visited once, no matter how many of the keys it leads to.
+        """
+        if not hasattr(self, 'key_size'):
+            self.read_header()
+        keys = sorted(set(keys))
+        assert all(len(key) == self.key_size for key in keys), 'Invalid key length'
+        values = {}
+        if keys:
+            self._get_many(self.root_block, keys, values)
+        return values
+
     def get_all_keys(self, start=None):
         """
         A generator which yields a list of all valid keys starting at the
         given `start` offset.  If `start` is `None`, we will start from
         the root of the tree.
         """
-        s = self.stream
+        if not hasattr(self, 'key_size'):
+            self.read_header()
         if not start:
-            start = HEADER_SIZE + self.block_size * self.root_block
-        s.seek(start)
-        block_type = s.read(2)
-        if block_type == LEAF:
-            reader = LeafReader(self)
-            num_keys = struct.unpack('>i', reader.read(4))[0]
+            block = self.root_block
+        else:
+            block = (start - HEADER_SIZE) // self.block_size
+        for key, _ in self._scan(block, None, None, False):
+            yield key
+
+    def items(self, start_key=None, end_key=None):
+        """
+        A generator which yields `(key, value)` pairs in key order for all
+        keys where `start_key <= key < end_key`, in a single pass over the
+        leaves. Either bound may be `None` to leave that end open. Values are
+        the same kind of objects as those returned by `get`.
+        """
+        if not hasattr(self, 'key_size'):
+            self.read_header()
+        return self._scan(self.root_block, start_key, end_key, True)
+
+    def keys(self, start_key=None, end_key=None):
+        """
+        Like `items`, but only yields the keys, skipping over the values.
+        """
+        if not hasattr(self, 'key_size'):
+            self.read_header()
+        return (key for key, _ in self._scan(self.root_block, start_key, end_key, False))
+
+    def prefix_items(self, prefix):
+        """
+        A generator which yields `(key, value)` pairs in key order for all
+        keys that start with `prefix`.
+        """
+        return self.items(prefix, _prefix_end(prefix))
+
+    def prefix_keys(self, prefix):
+        """
+        Like `prefix_items`, but only yields the keys.
+        """
+        return self.keys(prefix, _prefix_end(prefix))
+
+    def put(self, key, value):
+        """
+        Stages a new value for the given key. Staged changes are not visible
+        to reads until they've been written with `commit`.
+        """
+        if not hasattr(self, 'key_size'):
+            self.read_header()
+        assert len(key) == self.key_size, 'Invalid key length'
+        self.pending[_bytes(key)] = _bytes(value)
+
+    def delete(self, key):
+        """
+        Stages the removal of the given key. Keys that don't exist are
+        ignored by `commit`.
+        """
+        if not hasattr(self, 'key_size'):
+            self.read_header()
+        assert len(key) == self.key_size, 'Invalid key length'
+        self.pending[_bytes(key)] = None
+
+    def commit(self):
+        """
+        Writes all staged changes to the file, which must have been opened for
+        writing (not as a buffer). Only the leaves and index blocks on the path
+        to a changed key are rewritten, into blocks from the free list or at
+        the end of the file. The new root is then stored in place of the
+        alternate root and made the current one, so the previous version of
+        the tree stays intact until the header switches over.
+        """
+        if not hasattr(self, 'key_size'):
+            self.read_header()
+        if not self.pending:
+            return
+        if self.is_buffer:
+            raise ValueError('Cannot write to a database opened from a buffer')
+        if self.use_other_root:
+            free_head = self.free_block_2
+        else:
+            free_head = self.free_block_1
+        available, free_list_blocks = self._read_free_list(free_head)
+        self.stream.seek(0, 2)
+        block_count = (self.stream.tell() - HEADER_SIZE) // self.block_size
+        allocator = _BlockAllocator(available, block_count)
+        writer = _TreeWriter(self.stream, self.key_size, self.block_size, allocator)
+        # Blocks of the current tree can only be reused by the next commit.
+        freed = []
+        nodes, level = self._commit_node(self.root_block, sorted(self.pending.items()),
+                                         writer, freed)
+        if not nodes:
+            # Every key was deleted, so the root becomes an empty leaf.
+            writer._write_leaf()
+            nodes, level = writer.leaves, -1
+        root, level = writer._write_root(nodes, level)
+        free_head = self._write_free_list(writer, freed + free_list_blocks)
+        size = HEADER_SIZE + allocator.block_count * self.block_size
+        # Write the root info before flipping the selector to it.
+        use_other_root = not self.use_other_root
+        self.stream.seek(ROOT_INFO_OFFSETS[use_other_root])
+        self.stream.write(ROOT_INFO.pack(free_head, size, root, level < 0))
+        self.stream.flush()
+        self.stream.seek(ROOT_SELECTOR_OFFSET)
+        self.stream.write(struct.pack('>?', use_other_root))
+        self.stream.flush()
+        self.pending = {}
+        self.key_index = None
+        self.read_header()
+
+    def load_key_index(self, path=None, index_path=None):
+        """
+        Loads the key index sidecar file for this database, which is built and
+        saved first if it doesn't exist or if it's out of date. `path` is the
+        path of the database file (defaults to the name of the stream), and
+        `index_path` defaults to that path with `.pyidx` appended. Once
+        loaded, `get` uses the index instead of traversing the tree.
+        """
+        # Make sure the index is built from the database itself.
+        self.key_index = None
+        self.key_index = self._load_sidecar(KeyIndex, '.pyidx', path, index_path,
+                                            self.build_key_index)
+        return self.key_index
+
+    def build_key_index(self):
+        """
+        Scans the whole database and returns a `KeyIndex` with the location of
+        every value.
+        """
+        if not hasattr(self, 'key_size'):
+            self.read_header()
+        locations = {}
+        for block, data in self._leaves(self.root_block):
+            reader = LeafReader(self, data, block)
+            num_keys, = struct.unpack('>i', reader.read(4))
             for _ in range(num_keys):
-                cur_key = reader.read(self.key_size)
-                # We to a tell/seek here so that the user can read from
-                # the file while this loop is still being run
-                cur_pos = s.tell()
-                yield cur_key
-                s.seek(cur_pos)
-                length = sbon.read_varint(reader)
+                key = _bytes(reader.read(self.key_size))
+                length = reader.read_varint()
+                locations[key] = (reader.block, reader.offset, length)
                 reader.seek(length, 1)
-        elif block_type == INDEX:
-            (_, num_keys, first_child) = struct.unpack('>Bii', s.read(9))
-            children = [first_child]
-            for _ in range(num_keys):
-                # Skip the key field.
-                _ = s.read(self.key_size)
-                # Read pointer to the child block.
-                next_child = struct.unpack('>i', s.read(4))[0]
-                children.append(next_child)
-            for child_loc in children:
-                for key in self.get_all_keys(HEADER_SIZE + self.block_size * child_loc):
-                    yield key
-        elif block_type == FREE:
-            pass
-        else:
-            raise Exception('Unhandled block type: {}'.format(block_type))
+        return KeyIndex(self.key_size, locations, self._key_index_extras())
+
+    def decode_index(self, data):
+        """
+        Decodes the raw data of an index block into an `IndexNode`, where
+        `children[i]` is the block to follow for keys in the range
+        `keys[i - 1] <= key < keys[i]`.
+        """
+        level, num_keys, first_child = struct.unpack_from('>Bii', data, 2)
+        fmt = '>' + '{}si'.format(self.key_size) * num_keys
+        values = struct.unpack_from(fmt, data, 11)
+        return IndexNode(level, values[0::2], (first_child,) + values[1::2])
+
+    def read_block(self, block):
+        """
+        Reads the raw data of the block with the given index. This will be a
+        memoryview if the database was opened from a buffer.
+        """
+        return self.read_at(HEADER_SIZE + self.block_size * block, self.block_size)
+
+    def read_at(self, offset, length):
+        """
+        Reads `length` bytes at `offset` without relying on the stream
+        position, so it's safe to call from multiple threads.
+        """
+        if self.is_buffer:
+            return memoryview(self.stream)[offset:offset + length]
+        if self._fileno is not None:
+            return os.pread(self._fileno, length, offset)
+        with self._lock:
+            self.stream.seek(offset)
+            return self.stream.read(length)
+
+    def read_node(self, block):
+        """
+        Returns the block with the given index, going through the block cache
+        if there is one. Cached index blocks are returned decoded as an
+        `IndexNode`, all other blocks are returned as raw data.
+        """
+        cache = self.cache
+        if cache is None:
+            return self.read_block(block)
+        key = (self._cache_token, block)
+        node = cache.get(key)
+        if node is None:
+            node = self.read_block(block)
+            if node[:2] == INDEX:
+                node = self.decode_index(node)
+            else:
+                # Don't let the cache hold on to views of the buffer.
+                node = _bytes(node)
+            cache.put(key, node)
+        return node
 
     def read_header(self):
-        self.stream.seek(0)
-        data = struct.unpack(HEADER, self.stream.read(HEADER_SIZE))
+        data = struct.unpack(HEADER, self.read_at(0, HEADER_SIZE))
         assert data[0] == b'BTreeDB5', 'Invalid header'
         self.block_size = data[1]
         self.name = data[2].rstrip(b'\0').decode('utf-8')
@@ -122,6 +346,10 @@ class BTreeDB5(object):
         self.free_block_2_end = data[10]
         self.root_block_2 = data[11]
         self.root_block_2_is_leaf = data[12]
+        # Cached blocks are keyed by a token that is unique to this database
+        # and this version of the tree, so that the cache can be shared, and
+        # blocks from before a commit are never returned (they just age out).
+        self._cache_token = object()
 
     @property
     def root_block(self):
@@ -137,39 +365,562 @@ class BTreeDB5(object):
     def swap_root(self):
         self.use_other_root = not self.use_other_root
 
+    def _commit_node(self, block, changes, writer, freed):
+        # Rewrites the node with the given changes applied and returns the
+        # `(first key, block)` pairs of the nodes that replace it (there may be
+        # none, or several if it had to be split), as well as their level.
+        # Nodes are visited in key order, so the writer gets keys in order.
+        node = self.read_node(block)
+        if not isinstance(node, IndexNode) and node[:2] == INDEX:
+            node = self.decode_index(node)
+        if not isinstance(node, IndexNode):
+            assert node[:2] == LEAF, 'Did not reach a leaf'
+            entries = {}
+            reader = LeafReader(self, node, block)
+            num_keys, = struct.unpack('>i', reader.read(4))
+            for _ in range(num_keys):
+                key = _bytes(reader.read(self.key_size))
+                entries[key] = _bytes(reader.read(reader.read_varint()))
+            freed.extend(self._leaf_chain(block, node))
+            for key, value in changes:
+                if value is not None:
+                    entries[key] = value
+                elif key in entries:
+                    del entries[key]
+            # Leaves that end up empty are dropped along with their keys.
+            first_leaf = len(writer.leaves)
+            for key in sorted(entries):
+                writer.add(key, entries[key])
+            writer._flush_leaf()
+            return writer.leaves[first_leaf:], -1
+        # Hand each change to the child that covers its key.
+        groups = {}
+        for change in changes:
+            i = bisect.bisect_right(node.keys, change[0])
+            groups.setdefault(i, []).append(change)
+        keys, children = [], []
+        for i, child in enumerate(node.children):
+            if i in groups:
+                replacements, _ = self._commit_node(child, groups[i], writer, freed)
+            else:
+                replacements = [(None, child)]
+            for j, (key, child) in enumerate(replacements):
+                if j == 0:
+                    # The existing separator still covers the new first node.
+                    key = node.keys[i - 1] if i else None
+                if children:
+                    keys.append(key)
+                children.append(child)
+        freed.append(block)
+        if not children:
+            return [], node.level
+        nodes = [(None, child) for child in children[:1]]
+        nodes.extend(zip(keys, children[1:]))
+        return writer._write_index(node.level, nodes), node.level
+
+    def _get_many(self, block, keys, values):
+        node = self.read_node(block)
+        if not isinstance(node, IndexNode):
+            if node[:2] == INDEX:
+                node = self.decode_index(node)
+            else:
+                assert node[:2] == LEAF, 'Did not reach a leaf'
+                self._get_many_leaf(node, keys, values)
+                return
+        # Split the sorted keys into runs that belong to the same child.
+        i = 0
+        while i < len(keys):
+            child = bisect.bisect_right(node.keys, keys[i])
+            if child < len(node.keys):
+                j = bisect.bisect_left(keys, node.keys[child], i)
+            else:
+                j = len(keys)
+            self._get_many(node.children[child], keys[i:j], values)
+            i = j
+
+    def _get_many_leaf(self, data, keys, values):
+        wanted = set(keys)
+        last_key = keys[-1]
+        reader = LeafReader(self, data)
+        num_keys, = struct.unpack('>i', reader.read(4))
+        for _ in range(num_keys):
+            key = _bytes(reader.read(self.key_size))
+            length = reader.read_varint()
+            if key in wanted:
+                values[key] = reader.read(length)
+            elif key < last_key:
+                reader.seek(length, 1)
+            if key >= last_key:
+                break
+
+    def _key_index_extras(self):
+        # Subclasses can store additional (SBON serializable) data in the key
+        # index by overriding this method.
+        return {}
+
+    def _load_sidecar(self, index_class, extension, path, index_path, build):
+        # Loads an index of this database (e.g., a `KeyIndex`) from the file
+        # at `index_path`, which defaults to `path` with `extension` added.
+        # If the file is missing or the database has changed since it was
+        # saved, the index is built with `build` and saved instead.
+        if path is None:
+            path = getattr(self.stream, 'name', None)
+            if not isinstance(path, sbon._str_type):
+                raise ValueError('Database path is required for the index')
+        if index_path is None:
+            index_path = path + extension
+        if not hasattr(self, 'key_size'):
+            self.read_header()
+        signature = self._sidecar_signature(path)
+        try:
+            index = index_class.load(index_path)
+        except (IOError, OSError, ValueError, IndexError, struct.error):
+            index = None
+        if index is None or index.signature != signature:
+            index = build()
+            index.signature = signature
+            index.save(index_path)
+        return index
+
+    def _leaves(self, block):
+        # Yields `(block, data)` for all leaves under the given block, in order.
+        node = self.read_node(block)
+        if isinstance(node, IndexNode):
+            pass
+        elif node[:2] == INDEX:
+            node = self.decode_index(node)
+        elif node[:2] == LEAF:
+            yield block, node
+            return
+        elif node[:2] == FREE:
+            return
+        else:
+            raise Exception('Unhandled block type: {}'.format(_bytes(node[:2])))
+        for child in node.children:
+            for leaf in self._leaves(child):
+                yield leaf
+
+    def _leaf_chain(self, block, data):
+        # Returns all the blocks that make up the leaf starting at `block`.
+        blocks = [block]
+        while True:
+            block, = struct.unpack_from('>i', data, self.block_size - 4)
+            if block < 0:
+                return blocks
+            blocks.append(block)
+            data = self.read_block(block)
+
+    def _read_free_list(self, block):
+        # Returns the free blocks and the blocks that the list is stored in.
+        free, blocks = [], []
+        while block >= 0:
+            data = self.read_block(block)
+            assert data[:2] == FREE, 'Invalid free list block'
+            next_block, count = struct.unpack_from('>ii', data, 2)
+            free.extend(struct.unpack_from('>{}i'.format(count), data, 10))
+            blocks.append(block)
+            block = next_block
+        return free, blocks
+
+    def _scan(self, block, start_key, end_key, values):
+        node = self.read_node(block)
+        if isinstance(node, IndexNode):
+            pass
+        elif node[:2] == INDEX:
+            node = self.decode_index(node)
+        elif node[:2] == LEAF:
+            for item in self._scan_leaf(node, start_key, end_key, values):
+                yield item
+            return
+        elif node[:2] == FREE:
+            return
+        else:
+            raise Exception('Unhandled block type: {}'.format(_bytes(node[:2])))
+        # Only visit the children which may contain keys within the range.
+        lo, hi = 0, len(node.children)
+        if start_key is not None:
+            lo = bisect.bisect_right(node.keys, start_key)
+        if end_key is not None:
+            hi = bisect.bisect_left(node.keys, end_key) + 1
+        for child in node.children[lo:hi]:
+            for item in self._scan(child, start_key, end_key, values):
+                yield item
+
+    def _scan_leaf(self, data, start_key, end_key, values):
+        # The leaf reader holds on to its own block data, so the user can
+        # read from the database while this loop is still being run.
+        reader = LeafReader(self, data)
+        num_keys, = struct.unpack('>i', reader.read(4))
+        for _ in range(num_keys):
+            key = _bytes(reader.read(self.key_size))
+            length = reader.read_varint()
+            if start_key is not None and key < start_key:
+                reader.seek(length, 1)
+                continue
+            if end_key is not None and key >= end_key:
+                return
+            if values:
+                yield key, reader.read(length)
+            else:
+                yield key, None
+                reader.seek(length, 1)
+
+    def _search_index(self, data, key):
+        # Binary search the raw index block data for the closest key.
+        key_size = self.key_size
+        entry_size = key_size + 4
+        if isinstance(data, memoryview):
+            # Memoryviews can't be ordered, so compare against a copy.
+            data = data.tobytes()
+        lo, hi = 0, struct.unpack_from('>i', data, 3)[0]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = 11 + entry_size * mid
+            if key < data[offset:offset + key_size]:
+                hi = mid
+            else:
+                lo = mid + 1
+        if lo == 0:
+            return struct.unpack_from('>i', data, 7)[0]
+        return struct.unpack_from('>i', data, 11 + entry_size * (lo - 1) + key_size)[0]
+
+    def _sidecar_signature(self, path):
+        # The header changes on every commit, and the size and modification
+        # time catch any other changes to the file.
+        header = _bytes(self.read_at(0, HEADER_SIZE))
+        stat = os.stat(path)
+        return header, stat.st_size, int(stat.st_mtime * 1000000)
+
+    def _write_free_list(self, writer, freed):
+        # Writes the blocks that are free after this commit to a new free
+        # list and returns its first block.
+        allocator = writer.allocator
+        capacity = (self.block_size - 10) // 4
+        blocks = [allocator.allocate()]
+        while len(blocks) * capacity < len(allocator.available) + len(freed):
+            blocks.append(allocator.allocate())
+        free = allocator.available + freed
+        for i, block in enumerate(blocks):
+            chunk = free[i * capacity:(i + 1) * capacity]
+            next_block = blocks[i + 1] if i + 1 < len(blocks) else -1
+            data = FREE + struct.pack('>ii{}i'.format(len(chunk)), next_block, len(chunk), *chunk)
+            writer._write_block(block, data)
+        return blocks[0]
+
+
+class _TreeWriter(object):
+    # Packs key/value pairs (added in ascending key order) into leaves as
+    # they fill up, and builds index blocks on top of them. Blocks are taken
+    # from the allocator, which is what lets `BTreeDB5.commit` share this
+    # with `BTreeDB5Writer`.
+
+    def __init__(self, stream, key_size, block_size, allocator,
+                 leaf_keys=10, leaf_fill=.8, index_fill=.9):
+        assert block_size > key_size + 15, 'Block size too small for keys'
+        self.stream = stream
+        self.key_size = key_size
+        self.block_size = block_size
+        self.allocator = allocator
+        # Try not to exceed this number of keys or bytes per leaf.
+        self.leaf_keys = leaf_keys
+        self.leaf_size = int(block_size * leaf_fill)
+        # 11 is the number of bytes in the index header.
+        self.max_index_keys = (block_size - 11) // (key_size + 4)
+        self.index_keys = max(int(self.max_index_keys * index_fill), 1)
+        self.key_count = 0
+        # The first key and block of every leaf written so far.
+        self.leaves = []
+        self._buffer = bytearray()
+        self._first_key = None
+        self._last_key = None
+        self._num_keys = 0
+
+    def add(self, key, value):
+        if len(key) != self.key_size:
+            raise ValueError('Key must be {} bytes'.format(self.key_size))
+        if self._last_key is not None and key <= self._last_key:
+            raise ValueError('Keys must be added in ascending order')
+        if not self._num_keys:
+            self._first_key = key
+        self._buffer += key
+        self._buffer += sbon.dumps_varint(len(value))
+        self._buffer += value
+        self._last_key = key
+        self._num_keys += 1
+        self.key_count += 1
+        if self._num_keys >= self.leaf_keys or len(self._buffer) >= self.leaf_size:
+            self._write_leaf()
+
+    def _flush_leaf(self):
+        # Writes the pairs that haven't been written yet, if there are any.
+        if self._num_keys:
+            self._write_leaf()
+
+    def _write_block(self, block, data):
+        self.stream.seek(HEADER_SIZE + self.block_size * block)
+        self.stream.write(bytes(data.ljust(self.block_size, b'\x00')))
+
+    def _write_index(self, level, nodes):
+        # Writes index blocks pointing to the given `(first key, block)` pairs
+        # and returns the same kind of pairs for them. The nodes are split up
+        # into blocks filled to `index_fill` unless they fit in a single one.
+        if len(nodes) > self.max_index_keys + 1:
+            per_block = self.index_keys + 1
+        else:
+            per_block = len(nodes)
+        parents = []
+        for i in range(0, len(nodes), per_block):
+            children = nodes[i:i + per_block]
+            data = bytearray(INDEX)
+            data += struct.pack('>Bii', level, len(children) - 1, children[0][1])
+            for key, child in children[1:]:
+                data += key
+                data += struct.pack('>i', child)
+            block = self.allocator.allocate()
+            self._write_block(block, data)
+            parents.append((children[0][0], block))
+        return parents
+
+    def _write_leaf(self):
+        # 6 is the number of bytes used for signature + next block pointer.
+        leaf_bytes = self.block_size - 6
+        data = struct.pack('>i', self._num_keys) + bytes(self._buffer)
+        blocks = [self.allocator.allocate() for _ in range(0, len(data), leaf_bytes)]
+        for i, block in enumerate(blocks):
+            next_block = blocks[i + 1] if i + 1 < len(blocks) else -1
+            chunk = data[i * leaf_bytes:(i + 1) * leaf_bytes].ljust(leaf_bytes, b'\x00')
+            self._write_block(block, LEAF + chunk + struct.pack('>i', next_block))
+        self.leaves.append((self._first_key, blocks[0]))
+        del self._buffer[:]
+        self._first_key = None
+        self._num_keys = 0
+
+    def _write_root(self, nodes, level):
+        # Builds index levels on top of the nodes at `level` (-1 for leaves)
+        # until there's a single root, and returns its block and level.
+        while len(nodes) > 1:
+            level += 1
+            nodes = self._write_index(level, nodes)
+        return nodes[0][1], level
+
+
+class BTreeDB5Writer(_TreeWriter):
+    """
+    Writes a new BTreeDB5 file to a seekable stream. Pairs must be added in
+    ascending key order. Leaves are written out as soon as they fill up, so
+    only the first key of each leaf is kept around until `finish` builds the
+    index levels on top of them and writes the header.
+    """
+
+    # Same layout as `HEADER`, but with the 64-bit device sizes spelled out.
+    HEADER = struct.Struct('>8si16si?iqi?iqi?445x')
+
+    def __init__(self, stream, name, key_size, block_size=2048,
+                 leaf_keys=10, leaf_fill=.8, index_fill=.9):
+        super(BTreeDB5Writer, self).__init__(
+            stream, key_size, block_size, _BlockAllocator([], 0),
+            leaf_keys, leaf_fill, index_fill)
+        self.name = name
+        # Reserve space for the header, which is written last.
+        stream.seek(0)
+        stream.write(b'\x00' * HEADER_SIZE)
+
+    @property
+    def block_count(self):
+        return self.allocator.block_count
+
+    def finish(self):
+        """
+        Writes the remaining leaf data, the index and the header. The stream
+        is left open.
+        """
+        if self._num_keys or not self.leaves:
+            self._write_leaf()
+        # Starbound keeps two roots around, so build the index twice.
+        root, level = self._write_root(self.leaves, -1)
+        alternate_root, _ = self._write_root(self.leaves, -1)
+        # Each root gets an empty free index block.
+        free_1 = self.allocator.allocate()
+        self._write_block(free_1, FREE + b'\xff\xff\xff\xff')
+        free_2 = self.allocator.allocate()
+        self._write_block(free_2, FREE + b'\xff\xff\xff\xff')
+        size = HEADER_SIZE + self.block_count * self.block_size
+        self.stream.seek(0)
+        self.stream.write(self.HEADER.pack(
+            b'BTreeDB5', self.block_size, self.name.encode('utf-8'),
+            self.key_size, False,
+            free_1, size, root, level < 0,
+            free_2, size, alternate_root, level < 0))
+        self.stream.seek(size)
+
+
+class _BlockAllocator(object):
+    # Hands out free blocks first, then new blocks at the end of the file.
+    def __init__(self, available, block_count):
+        self.available = list(available)
+        self.block_count = block_count
+
+    def allocate(self):
+        if self.available:
+            return self.available.pop()
+        self.block_count += 1
+        return self.block_count - 1
+
+
+def read_sidecar(path, magic):
+    """
+    Reads a file saved with `write_sidecar` and checks its magic bytes.
+    Returns the signature stored in the file, all of its data, and the
+    offset in the data where the part written by the caller starts.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(magic)] != magic:
+        raise ValueError('Not a {} file'.format(magic.decode('ascii')))
+    offset = len(magic)
+    size, mtime = struct.unpack_from('>Qq', data, offset)
+    offset += 16
+    header = data[offset:offset + HEADER_SIZE]
+    return (header, size, mtime), data, offset + HEADER_SIZE
+
+
+def write_sidecar(path, magic, signature, parts):
+    """
+    Saves a file with data about a database (such as a `KeyIndex`) next to
+    it. The file starts with `magic` and the `(header, size, mtime)`
+    signature of the database, followed by the bytes in `parts`. It's
+    written to a temporary file first, so a partial file is never seen.
+    """
+    header, size, mtime = signature
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('>Qq', size, mtime))
+        f.write(header)
+        for part in parts:
+            f.write(part)
+    getattr(os, 'replace', os.rename)(temp_path, path)
+
+
+def _prefix_end(prefix):
+    # Returns the smallest key greater than all keys starting with the prefix,
+    # or `None` if there is no such key.
+    end = bytearray(prefix.rstrip(b'\xff'))
+    if not end:
+        return None
+    end[-1] += 1
+    return bytes(end)
+
+
+class KeyIndex(object):
+    """
+    The location (block, offset within the block, and length) of the value of
+    every key in a BTreeDB5 database, along with any extra data the database
+    class wants to keep. It can be saved as a sidecar file next to the
+    database, along with a signature which is used to detect when the
+    database has changed.
+    """
+
+    MAGIC = b'PYIDX2'
+
+    def __init__(self, key_size, locations, extras=None, signature=None):
+        self.key_size = key_size
+        self.locations = locations
+        self.extras = extras or {}
+        self.signature = signature
+
+    @classmethod
+    def load(cls, path):
+        signature, data, offset = read_sidecar(path, cls.MAGIC)
+        key_size, = struct.unpack_from('>i', data, offset)
+        count, offset = sbon.loads_varint(data, offset + 4)
+        entry = struct.Struct('>{}siII'.format(key_size))
+        locations = {}
+        for _ in range(count):
+            key, block, block_offset, length = entry.unpack_from(data, offset)
+            locations[key] = (block, block_offset, length)
+            offset += entry.size
+        extras, _ = sbon.loads(data, offset)
+        return cls(key_size, locations, extras, signature)
+
+    def save(self, path):
+        entry = struct.Struct('>{}siII'.format(self.key_size))
+        parts = [struct.pack('>i', self.key_size), sbon.dumps_varint(len(self.locations))]
+        for key in sorted(self.locations):
+            parts.append(entry.pack(key, *self.locations[key]))
+        parts.append(sbon.dumps(self.extras))
+        write_sidecar(path, self.MAGIC, self.signature, parts)
+
 
 class LeafReader(object):
-    def __init__(self, db):
-        # The stream offset must be right after an "LL" marker.
+    def __init__(self, db, data, block=None):
+        # The data must be that of a leaf block. Leaf data may continue in
+        # other blocks, so keep track of the current block and our offset.
+        assert data[:2] == LEAF, 'Not a leaf'
         self.db = db
+        self.data = data
+        self.block = block
         self.offset = 2
 
     def read(self, size=-1):
         if size < 0:
-            raise NotImplemented('Can only read specific amount')
-        with io.BytesIO() as data:
-            for length in self._traverse(size):
-                data.write(self.db.stream.read(length))
-            return data.getvalue()
+            raise NotImplementedError('Can only read specific amount')
+        end = self.offset + size
+        if end <= self.db.block_size - 4:
+            # Fast path for data that is entirely within the current block.
+            data = self.data[self.offset:end]
+            self.offset = end
+            return data
+        # Not a `b''.join`, which doesn't take memoryviews on Python 2.
+        data = bytearray()
+        for start, end in self._traverse(size):
+            data += self.data[start:end]
+        return bytes(data)
+
+    def read_varint(self):
+        # Same as `sbon.read_varint`, but indexes the block data directly.
+        data, offset = _indexable(self.data), self.offset
+        block_end = self.db.block_size - 4
+        value = 0
+        while offset < block_end:
+            byte = data[offset]
+            offset += 1
+            if not byte & 0b10000000:
+                self.offset = offset
+                return value << 7 | byte
+            value = value << 7 | (byte & 0b01111111)
+        # The varint continues in the next block.
+        self.offset = offset
+        while True:
+            byte = bytearray(self.read(1))[0]
+            if not byte & 0b10000000:
+                return value << 7 | byte
+            value = value << 7 | (byte & 0b01111111)
 
     def seek(self, offset, whence=0):
         if whence != 1 or offset < 0:
-            raise NotImplemented('Can only seek forward relatively')
-        for length in self._traverse(offset):
-            self.db.stream.seek(length, 1)
+            raise NotImplementedError('Can only seek forward relatively')
+        # Skip whole blocks without looking at anything but the next pointer.
+        block_end = self.db.block_size - 4
+        position = self.offset + offset
+        while position > block_end:
+            position -= block_end - 2
+            self._next_block()
+        self.offset = position
+
+    def _next_block(self):
+        block, = struct.unpack_from('>i', self.data, self.db.block_size - 4)
+        assert block >= 0, 'Could not traverse to next block'
+        self.data = self.db.read_node(block)
+        self.block = block
+        assert self.data[:2] == LEAF, 'Did not reach a leaf'
 
     def _traverse(self, length):
         block_end = self.db.block_size - 4
-        while True:
-            if self.offset + length <= block_end:
-                yield length
-                self.offset += length
-                break
-            delta = block_end - self.offset
-            yield delta
-            block, = struct.unpack('>i', self.db.stream.read(4))
-            assert block >= 0, 'Could not traverse to next block'
-            self.db.stream.seek(HEADER_SIZE + self.db.block_size * block)
-            assert self.db.stream.read(2) == LEAF, 'Did not reach a leaf'
+        while self.offset + length > block_end:
+            yield self.offset, block_end
+            length -= block_end - self.offset
+            self._next_block()
             self.offset = 2
-            length -= delta
+        yield self.offset, self.offset + length
+        self.offset += length
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A cache which holds on to at most `max_size` values, evicting the least
+    recently used value first. It keeps count of hits and misses.
+
+    It can be shared between threads without a lock: every operation on the
+    underlying dict is atomic, so at worst the order of eviction or the
+    counts are slightly off when threads race.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __len__(self):
+        return len(self._values)
+
+    def clear(self):
+        self._values.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self._values.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # Reinsert the value to mark it as the most recently used one.
+        self._values[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._values.pop(key, None)
+        self._values[key] = value
+        while len(self._values) > self.max_size:
+            self._values.popitem(last=False)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import mmap
+import optparse
+import signal
+
+import starbound
+
+
+try:
+    # Don't break on pipe signal.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+except:
+    # Probably a Windows machine.
+    pass
+
+
+def main():
+    p = optparse.OptionParser('Usage: %prog [options] <old world> <new world>')
+    p.add_option('-r', '--regions', dest='regions',
+                 action='store_true', default=False,
+                 help='List the changed fields of every changed region')
+    options, arguments = p.parse_args()
+    if len(arguments) != 2:
+        p.error('Incorrect number of arguments')
+    worlds = []
+    for path in arguments:
+        with open(path, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            worlds.append(starbound.World(mm))
+    diff = starbound.diff_worlds(*worlds)
+    print('Metadata changed:  {}'.format('yes' if diff.metadata_changed else 'no'))
+    print('Regions added:     {}'.format(len(diff.added_regions)))
+    print('Regions removed:   {}'.format(len(diff.removed_regions)))
+    print('Regions changed:   {}'.format(len(diff.changed_regions)))
+    for field in starbound.Tile._fields:
+        if field in diff.field_changes:
+            print('  {}: {} tiles'.format(field, diff.field_changes[field]))
+    if options.regions:
+        print('')
+        for coords in diff.added_regions:
+            print('+ ({}, {})'.format(*coords))
+        for coords in diff.removed_regions:
+            print('- ({}, {})'.format(*coords))
+        for coords in sorted(diff.changed_regions):
+            fields = diff.changed_regions[coords]
+            print('~ ({}, {}): {}'.format(coords[0], coords[1], ', '.join(
+                '{} {}'.format(field, fields[field])
+                for field in starbound.Tile._fields if field in fields)))
+    print('')
+    for prefix, uuids in (('+', diff.added_entities),
+                          ('-', diff.removed_entities),
+                          ('~', diff.changed_entities)):
+        for uuid in uuids:
+            print('{} {}'.format(prefix, uuid))
+
+
+if __name__ == '__main__':
+    main()
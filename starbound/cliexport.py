@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from __future__ import print_function
+
 import mmap
 import optparse
-import os
 import sys
 import time
 
@@ -14,6 +15,12 @@ def main():
     p = optparse.OptionParser('Usage: %prog <package path>')
     p.add_option('-d', '--destination', dest='path',
                  help='Destination directory')
+    p.add_option('-f', '--filter', dest='pattern',
+                 help='Only extract files with paths matching this glob '
+                      '(e.g., "/items/*.item")')
+    p.add_option('-j', '--jobs', dest='workers',
+                 type=int, default=4,
+                 help='Number of files to write in parallel')
     options, arguments = p.parse_args()
     # Validate the arguments.
     if len(arguments) != 1:
@@ -21,37 +28,37 @@ def main():
     package_path = arguments[0]
     base = options.path if options.path else '.'
     # Load the assets file and its index.
-    start = time.clock()
+    start = time.time()
     with open(package_path, 'rb') as fh:
         mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
         package = starbound.SBAsset6(mm)
         print('Loading index...')
         # Get the paths from the index in the database.
         package.read_index()
-        print('Index loaded. Extracting {} files...'.format(package.file_count))
+        if options.pattern:
+            file_count = len(package.find_paths(options.pattern))
+        else:
+            file_count = package.file_count
+        print('Index loaded. Extracting {} files...'.format(file_count))
         # Start extracting everything.
-        num_files = 0
-        percentage_count = max(package.file_count // 100, 1)
-        for path in package.index:
-            dest_path = base + path
-            dir_path = os.path.dirname(dest_path)
-            if not os.path.exists(dir_path):
-                os.makedirs(dir_path)
-            try:
-                data = package.get(path)
-            except:
+        percentage_count = max(file_count // 100, 1)
+        progress = {'done': 0}
+
+        def callback(path, error):
+            if error is not None:
                 # Break the dots in case std{out,err} are the same tty:
                 sys.stdout.write('\n')
                 sys.stdout.flush()
-                print >>sys.stderr, 'W: Failed to read', path
-                continue
-            with open(dest_path, 'wb') as file:
-                file.write(data)
-            num_files += 1
-            if not num_files % percentage_count:
+                print('W: Failed to read', path, file=sys.stderr)
+                return
+            progress['done'] += 1
+            if not progress['done'] % percentage_count:
                 sys.stdout.write('.')
                 sys.stdout.flush()
-    elapsed = time.clock() - start
+
+        num_files = package.extract_all(base, workers=options.workers,
+                                        pattern=options.pattern, callback=callback)
+    elapsed = time.time() - start
     print('')
     print('Extracted {} files in {:.1f} seconds.'.format(num_files, elapsed))
 
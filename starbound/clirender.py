@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import mmap
+import optparse
+import time
+
+import starbound
+import starbound.render
+
+
+def main():
+    p = optparse.OptionParser('Usage: %prog [options] <world path>')
+    p.add_option('-o', '--output', dest='output',
+                 help='Where to write the PNG (defaults to the world path '
+                      'with .png added to the end)')
+    p.add_option('-b', '--bbox', dest='bbox',
+                 help='Only render the tiles in this box (min_x,min_y,max_x,max_y)')
+    p.add_option('-c', '--collision', dest='collision',
+                 action='store_true', default=False,
+                 help='Draw an overlay of the collision kind of each tile')
+    p.add_option('-l', '--layers', dest='layers',
+                 default=','.join(starbound.render.DEFAULT_LAYERS),
+                 help='Comma separated layers to draw, from the bottom up '
+                      '(default: %default)')
+    p.add_option('-s', '--scale', dest='scale',
+                 type=int, default=1,
+                 help='Number of pixels per tile')
+    p.add_option('-t', '--tiles', dest='tiles',
+                 help='Build (or update) a pyramid of map tiles in this '
+                      'directory instead of rendering a single image')
+    p.add_option('--tile-size', dest='tile_size',
+                 type=int, default=256,
+                 help='Size of each map tile in pixels (default: %default)')
+    p.add_option('-j', '--jobs', dest='workers',
+                 type=int, default=4,
+                 help='Number of bands of regions to render in parallel')
+    options, arguments = p.parse_args()
+    if len(arguments) != 1:
+        p.error('Only one argument is supported (world path)')
+    path = arguments[0]
+    bbox = None
+    if options.bbox:
+        try:
+            bbox = tuple(int(v) for v in options.bbox.split(','))
+            assert len(bbox) == 4
+        except (AssertionError, ValueError):
+            p.error('The bounding box must be four comma separated integers')
+    layers = tuple(layer for layer in options.layers.split(',') if layer)
+    start = time.time()
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        world = starbound.World(mm)
+        if options.tiles:
+            if bbox:
+                p.error('A bounding box can\'t be used with --tiles')
+            count = starbound.render.build_tile_pyramid(
+                world, options.tiles, tile_size=options.tile_size, scale=options.scale,
+                layers=layers, collision=options.collision, workers=options.workers)
+            elapsed = time.time() - start
+            print('Rendered {} map tiles in {:.1f} seconds.'.format(count, elapsed))
+            return
+        with open(options.output or path + '.png', 'wb') as out:
+            width, height = starbound.render.render_world(
+                world, out, bbox=bbox, layers=layers, collision=options.collision,
+                scale=options.scale, workers=options.workers)
+    elapsed = time.time() - start
+    print('Rendered {}×{} image in {:.1f} seconds.'.format(width, height, elapsed))
+
+
+if __name__ == '__main__':
+    main()
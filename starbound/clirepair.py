@@ -5,6 +5,7 @@ from __future__ import print_function
 
 import io
 import math
+import mmap
 import optparse
 import os
 import os.path
@@ -31,6 +32,76 @@ except:
     pass
 
 
+# Number of blocks handed to a worker at a time.
+CHUNK_BLOCKS = 4096
+
+
+def scan_blocks(chunk):
+    """
+    Scans the given range of blocks for leaves and returns the valid keys in
+    them (along with where their data starts), as well as any messages about
+    broken data. The data is validated but stays compressed.
+    """
+    path, start, end, regions_x, regions_y = chunk
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    world = starbound.btreedb5.BTreeDB5(mm)
+    world.read_header()
+    records = []
+    messages = []
+    for index in range(start, end):
+        # Read the block and only process it if it's a leaf.
+        block = world.read_block(index)
+        if block[:2] != starbound.btreedb5.LEAF:
+            continue
+        stream = starbound.btreedb5.LeafReader(world, block, index)
+        try:
+            num_keys, = struct.unpack('>i', stream.read(4))
+        except Exception as e:
+            messages.append('failed to read keys of leaf block #{}: {}'.format(index, e))
+            continue
+        # Ensure that the number of keys makes sense, otherwise skip the leaf.
+        if num_keys > 100:
+            continue
+        for i in range(num_keys):
+            try:
+                cur_key = bytes(stream.read(world.key_size))
+                location = stream.block, stream.offset
+                cur_data = stream.read(stream.read_varint())
+            except Exception as e:
+                messages.append('could not read key/data: {}'.format(e))
+                break
+            layer, x, y = struct.unpack('>BHH', cur_key)
+            # Skip this leaf if we encounter impossible indexes.
+            if layer == 0 and (x != 0 or y != 0):
+                break
+            if layer not in (0, 1, 2) or x >= regions_x or y >= regions_y:
+                break
+            try:
+                result = zlib.decompress(cur_data)
+            except Exception as e:
+                messages.append('broken leaf node: {}'.format(e))
+                continue
+            # Validate the data before storing it.
+            try:
+                if layer == 0:
+                    temp_stream = io.BytesIO(result)
+                    temp_stream.seek(8)
+                    name, _, _ = starbound.read_versioned_json(temp_stream)
+                    assert name == 'WorldMetadata', 'broken world metadata'
+                elif layer == 1:
+                    assert len(result) == 3 + 32 * 32 * 30, 'broken region data'
+                elif layer == 2:
+                    temp_stream = io.BytesIO(result)
+                    for _ in range(starbound.sbon.read_varint(temp_stream)):
+                        starbound.read_versioned_json(temp_stream)
+            except Exception as e:
+                messages.append('invalid key data: {}'.format(e))
+                continue
+            records.append((cur_key, location))
+    return records, messages
+
+
 def main():
     p = optparse.OptionParser('Usage: %prog [options] <input file>')
     p.add_option('-f', '--force', dest='force',
@@ -39,6 +110,9 @@ def main():
     p.add_option('-o', '--output', dest='output',
                  help='where to output repaired world (defaults to input file '
                       'path with .repaired added to the end)')
+    p.add_option('-j', '--jobs', dest='workers',
+                 type=int, default=4,
+                 help='Number of processes to scan blocks with')
     p.add_option('-w', '--blank-world', dest='world',
                  help='the blank .world file that was created in place of the '
                       '.fail one (for metadata recovery)')
@@ -76,8 +150,9 @@ def main():
             blank_world = starbound.World(open(options.world, 'rb'))
         except Exception as e:
             p.error('could not open blank world ({})'.format(e))
-    # This dict will contain all the keys and their data.
-    data = dict()
+    # This dict will map every recovered key to the block and offset of its
+    # data, so that the data itself doesn't have to be kept in memory.
+    locations = dict()
     try:
         world.read_metadata()
         metadata, version = world.metadata, world.metadata_version
@@ -100,94 +175,46 @@ def main():
     regions_y = int(math.ceil(size[1] / 32))
     print('attempting to recover {}×{} regions...'.format(regions_x, regions_y))
     block_count = int((file_size - starbound.btreedb5.HEADER_SIZE) / world.block_size)
-    blocks_per_percent = block_count // 100 + 1
     nodes_recovered = 0
-    percent = 0
-    # Find all leaves and try to read them individually.
-    for index in range(block_count):
-        if index % blocks_per_percent == 0:
-            print('{}% ({} nodes recovered)'.format(percent, nodes_recovered))
-            percent += 1
-        # Seek to the block and only process it if it's a leaf.
-        world.stream.seek(starbound.btreedb5.HEADER_SIZE + world.block_size * index)
-        if world.stream.read(2) != starbound.btreedb5.LEAF:
-            continue
-        stream = starbound.btreedb5.LeafReader(world)
-        try:
-            num_keys, = struct.unpack('>i', stream.read(4))
-        except Exception as e:
-            print('failed to read keys of leaf block #{}: {}'.format(index, e))
-            continue
-        # Ensure that the number of keys makes sense, otherwise skip the leaf.
-        if num_keys > 100:
-            continue
-        for i in range(num_keys):
-            try:
-                cur_key = stream.read(world.key_size)
-                cur_data = starbound.sbon.read_bytes(stream)
-            except Exception as e:
-                print('could not read key/data: {}'.format(e))
-                break
-            layer, x, y = struct.unpack('>BHH', cur_key)
-            # Skip this leaf if we encounter impossible indexes.
-            if layer == 0 and (x != 0 or y != 0):
-                break
-            if layer not in (0, 1, 2) or x >= regions_x or y >= regions_y:
-                break
-            result = None
-            if cur_key in data:
-                # Duplicates should be checked up against the index, which always wins.
-                # TODO: Make this code run again.
-                try:
-                    #result = world.get(layer, x, y)
-                    result = None
-                except Exception:
-                    world.swap_root()
-                    try:
-                        #result = world.get(layer, x, y)
-                        result = None
-                    except Exception:
-                        pass
-                    world.swap_root()
-            # Use the data from this leaf if not using the index.
-            if not result:
-                try:
-                    result = zlib.decompress(cur_data)
-                except Exception as e:
-                    print('broken leaf node: {}'.format(e))
-                    continue
-            # Validate the data before storing it.
-            try:
-                if layer == 0:
-                    temp_stream = io.BytesIO(result)
-                    temp_stream.seek(8)
-                    name, _, _ = starbound.read_versioned_json(temp_stream)
-                    assert name == 'WorldMetadata', 'broken world metadata'
-                elif layer == 1:
-                    assert len(result) == 3 + 32 * 32 * 30, 'broken region data'
-                elif layer == 2:
-                    temp_stream = io.BytesIO(result)
-                    for _ in range(starbound.sbon.read_varint(temp_stream)):
-                        starbound.read_versioned_json(temp_stream)
-            except Exception as e:
-                print('invalid key data: {}'.format(e))
-                continue
+    # Find all leaves and try to read them individually. The blocks are split
+    # into chunks which are scanned by separate processes.
+    chunks = [(arguments[0], index, min(index + CHUNK_BLOCKS, block_count),
+               regions_x, regions_y)
+              for index in range(0, block_count, CHUNK_BLOCKS)]
+    if options.workers > 1:
+        # Needs the `futures` backport on Python 2.
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(options.workers)
+        results = executor.map(scan_blocks, chunks)
+    else:
+        executor = None
+        results = map(scan_blocks, chunks)
+    # Results come back in block order, so later leaves win just like they
+    # would when scanning sequentially.
+    for i, (records, messages) in enumerate(results):
+        for message in messages:
+            print(message)
+        for key, location in records:
             # Count the node the first time it's stored.
-            if cur_key not in data:
+            if key not in locations:
                 nodes_recovered += 1
-            data[cur_key] = zlib.compress(result)
+            locations[key] = location
+        print('{}% ({} nodes recovered)'.format((i + 1) * 100 // len(chunks), nodes_recovered))
+    if executor:
+        executor.shutdown()
     METADATA_KEY = b'\x00\x00\x00\x00\x00'
+    metadata_data = None
     # Ensure that the metadata key is in the data.
-    if METADATA_KEY not in data:
+    if METADATA_KEY not in locations:
         if options.world:
             try:
-                data[METADATA_KEY] = blank_world.get(0, 0, 0)
+                metadata_data = zlib.compress(blank_world.get(0, 0, 0))
             except Exception:
                 p.error('failed to recover metadata from alternate world')
         else:
             if options.force:
                 try:
-                    data[METADATA_KEY] = world.get(0, 0, 0)
+                    metadata_data = zlib.compress(world.get(0, 0, 0))
                     print('warning: using partially recovered metadata')
                 except Exception:
                     p.error('failed to recover partial metadata')
@@ -196,124 +223,19 @@ def main():
                         'from another world, or -f to attempt partial recovery')
     print('done! {} nodes recovered'.format(nodes_recovered))
     print('creating BTree database...')
-    # Try not to exceed this number of keys per leaf.
-    LEAF_KEYS_TRESHOLD = 10
-    # Try not to exceed this size for a leaf.
-    LEAF_SIZE_TRESHOLD = world.block_size * .8
-    # Fill indexes up to this ratio.
-    INDEX_FILL = .9
-    # 6 is the number of bytes used for signature + next block pointer.
-    LEAF_BYTES = world.block_size - 6
-    # 11 is the number of bytes in the index header.
-    INDEX_BYTES = world.block_size - 11
-    # Maximum number of keys that can go into an index.
-    INDEX_MAX_KEYS = int(INDEX_BYTES // (world.key_size + 4) * INDEX_FILL)
-    # The data of individual blocks will be stored in this list.
-    blocks = []
-    buffer = io.BytesIO()
-
-    # This will create an initial leaf and connect it to following leaves which
-    # will all contain the data currently in the buffer.
-    def dump_buffer():
-        buffer_size = buffer.tell()
-        buffer.seek(0)
-        block_data = b'LL' + struct.pack('>i', num_keys) + buffer.read(LEAF_BYTES - 4)
-        while buffer.tell() < buffer_size:
-            blocks.append(block_data + struct.pack('>i', len(blocks) + 1))
-            block_data = b'LL' + buffer.read(LEAF_BYTES)
-        blocks.append(block_data.ljust(world.block_size - 4, b'\x00') + struct.pack('>i', -1))
-        # Empty the buffer.
-        buffer.seek(0)
-        buffer.truncate()
-
-    # The number of keys that will be stored in the next created leaf.
-    num_keys = 0
-    # Map of key range to leaf block pointer.
-    range_to_leaf = dict()
-    # All the keys, sorted (important).
-    keys = sorted(data)
-    # Build all the leaf blocks.
-    min_key = None
-    for key in keys:
-        if not num_keys:
-            # Remember the first key of the leaf.
-            min_key = key
-        buffer.write(key)
-        starbound.sbon.write_bytes(buffer, data[key])
-        num_keys += 1
-        # Empty buffer once one of the tresholds is reached.
-        if num_keys >= LEAF_KEYS_TRESHOLD or buffer.tell() >= LEAF_SIZE_TRESHOLD:
-            range_to_leaf[(min_key, key)] = len(blocks)
-            dump_buffer()
-            num_keys = 0
-    # Empty any remaining data in the buffer.
-    if buffer.tell():
-        range_to_leaf[(min_key, key)] = len(blocks)
-        dump_buffer()
-    print('created {} blocks containing world data'.format(len(blocks)))
-
-    def build_index_level(range_to_block, level=0):
-        # Get a list of ranges that this index level needs to point to.
-        index_ranges = sorted(range_to_block)
-        # The new list of ranges that the next level of indexes can use.
-        new_ranges = dict()
-        for i in range(0, len(index_ranges), INDEX_MAX_KEYS):
-            ranges = index_ranges[i:i + INDEX_MAX_KEYS]
-            min_key, _ = ranges[0]
-            _, max_key = ranges[-1]
-            left_block = range_to_block[ranges.pop(0)]
-            index_data = io.BytesIO()
-            index_data.write(b'II' + struct.pack('>Bii', level, len(ranges), left_block))
-            for key_range in ranges:
-                index_data.write(key_range[0] + struct.pack('>i', range_to_block[key_range]))
-            new_ranges[(min_key, max_key)] = len(blocks)
-            blocks.append(index_data.getvalue().ljust(world.block_size, b'\x00'))
-        print('- created {} index(es) for level {}'.format(len(new_ranges), level))
-        return new_ranges
-
-    # Build the indexes in multiple levels up to a single root node.
-    print('creating root node...')
-    root_is_leaf = True
-    level = 0
-    current_index = range_to_leaf
-    while len(current_index) > 1:
-        current_index = build_index_level(current_index, level)
-        root_is_leaf = False
-        level += 1
-    root_node = list(current_index.values())[0]
-    # Also build an alternative root node.
-    print('creating alternate root node...')
-    alternate_root_is_leaf = True
-    level = 0
-    current_index = range_to_leaf
-    while len(current_index) > 1:
-        current_index = build_index_level(current_index, level)
-        alternate_root_is_leaf = False
-        level += 1
-    alternate_root_node = list(current_index.values())[0]
-    # The last two blocks will be free blocks.
-    blocks.append(b'FF\xFF\xFF\xFF\xFF' + b'\x00' * (world.block_size - 6))
-    blocks.append(b'FF\xFF\xFF\xFF\xFF' + b'\x00' * (world.block_size - 6))
-    print('writing all the data to disk...')
     with open(out_name, 'wb') as f:
-        header = struct.pack(
-            starbound.btreedb5.HEADER,
-            b'BTreeDB5',
-            world.block_size,
-            world.name.encode('utf-8') + b'\x00' * (16 - len(world.name)),
-            world.key_size,
-            False,
-            len(blocks) - 1,
-            14282,  # XXX: Unknown value!
-            root_node,
-            root_is_leaf,
-            len(blocks) - 2,
-            14274,  # XXX: Unknown value!
-            alternate_root_node,
-            alternate_root_is_leaf)
-        f.write(header)
-        for block in blocks:
-            f.write(block)
+        writer = starbound.btreedb5.BTreeDB5Writer(
+            f, world.name, world.key_size, block_size=world.block_size)
+        if metadata_data is not None:
+            writer.add(METADATA_KEY, metadata_data)
+        # Read the values back from the leaves they were found in, in key order.
+        for key in sorted(locations):
+            block, offset = locations[key]
+            stream = starbound.btreedb5.LeafReader(world, world.read_block(block), block)
+            stream.offset = offset
+            writer.add(key, stream.read(stream.read_varint()))
+        writer.finish()
+    print('created {} blocks'.format(writer.block_count))
     print('done!')
 
 
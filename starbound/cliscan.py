@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import json
+import optparse
+import os
+import os.path
+import signal
+import sys
+import time
+
+import starbound.scan
+
+
+try:
+    # Don't break on pipe signal.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+except:
+    # Probably a Windows machine.
+    pass
+
+
+def main():
+    p = optparse.OptionParser('Usage: %prog [options] <universe directory or .world files...>',
+                              description='Only .world files are scanned in directories; '
+                                          'celestial files (universe.chunks, .system) are skipped.')
+    p.add_option('-d', '--dungeon', dest='dungeons',
+                 action='append', default=[],
+                 help='Find the worlds that have this dungeon')
+    p.add_option('-e', '--entity', dest='entities',
+                 action='append', default=[],
+                 help='Find the world and position of the entity with this unique id')
+    p.add_option('-t', '--dungeon-tiles', dest='dungeon_ids',
+                 action='append', default=[], type=int,
+                 help='Count the tiles with this dungeon id in every world '
+                      '(65532 for tiles placed by players)')
+    p.add_option('-o', '--output', dest='output',
+                 help='Append the result for every world to this file (one '
+                      'JSON object per line), and skip the worlds that are '
+                      'already in it, so that an interrupted scan can be resumed')
+    p.add_option('-j', '--jobs', dest='workers',
+                 type=int, default=4,
+                 help='Number of worlds to scan in parallel')
+    options, arguments = p.parse_args()
+    if not arguments:
+        p.error('No universe directory or world files given')
+    queries = [('dungeon', name) for name in options.dungeons]
+    queries += [('entity', uuid) for uuid in options.entities]
+    queries += [('dungeon_tiles', dungeon_id) for dungeon_id in options.dungeon_ids]
+    if not queries:
+        p.error('Nothing to look for (use --dungeon, --entity or --dungeon-tiles)')
+    paths = []
+    for argument in arguments:
+        if os.path.isdir(argument):
+            for dirpath, _, filenames in os.walk(argument):
+                paths.extend(os.path.join(dirpath, name) for name in sorted(filenames)
+                             if name.endswith('.world'))
+        else:
+            paths.append(argument)
+    # Load the results of a previous run so they can be skipped.
+    previous = {}
+    if options.output and os.path.exists(options.output):
+        with open(options.output) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete if the scan was killed.
+                    continue
+                previous[record['path']] = record
+    keys = ['{}:{}'.format(query_type, argument) for query_type, argument in queries]
+
+    def is_done(path):
+        record = previous.get(path)
+        if record is None or 'results' not in record:
+            return False
+        stat = os.stat(path)
+        return (record['size'] == stat.st_size and record['mtime'] == stat.st_mtime and
+                all(key in record['results'] for key in keys))
+
+    totals = Totals(keys)
+    for record in previous.values():
+        if record['path'] in paths and is_done(record['path']):
+            totals.add(record, quiet=True)
+    print('Scanning {} worlds ({} already done)...'.format(
+        len(paths), totals.worlds), file=sys.stderr)
+    start = time.time()
+    out = open(options.output, 'a') if options.output else None
+    try:
+        for record in starbound.scan.scan_universe(paths, queries, options.workers, is_done):
+            totals.add(record)
+            if out:
+                out.write(json.dumps(record, sort_keys=True) + '\n')
+                out.flush()
+    finally:
+        if out:
+            out.close()
+    elapsed = time.time() - start
+    print('', file=sys.stderr)
+    print('Scanned {} worlds in {:.1f} seconds ({} errors).'.format(
+        totals.worlds, elapsed, totals.errors), file=sys.stderr)
+    for key in keys:
+        if key.startswith('dungeon_tiles:'):
+            print('{}: {} tiles in total'.format(key, totals.tiles[key]))
+        else:
+            print('{}: found in {} worlds'.format(key, totals.found[key]))
+
+
+class Totals(object):
+    # Prints hits as they come in and keeps the aggregated results.
+    def __init__(self, keys):
+        self.errors = 0
+        self.found = dict((key, 0) for key in keys)
+        self.keys = keys
+        self.tiles = dict((key, 0) for key in keys)
+        self.worlds = 0
+
+    def add(self, record, quiet=False):
+        self.worlds += 1
+        if 'error' in record:
+            self.errors += 1
+            if not quiet:
+                print('W: {}: {}'.format(record['path'], record['error']), file=sys.stderr)
+            return
+        for key in self.keys:
+            value = record['results'].get(key)
+            if key.startswith('dungeon_tiles:'):
+                self.tiles[key] += value or 0
+                if value and not quiet:
+                    print('{}\t{}\t{}'.format(key, record['path'], value))
+            elif value:
+                self.found[key] += 1
+                if not quiet:
+                    if value is True:
+                        print('{}\t{}'.format(key, record['path']))
+                    else:
+                        print('{}\t{}\t{}'.format(key, record['path'], json.dumps(value)))
+
+
+if __name__ == '__main__':
+    main()
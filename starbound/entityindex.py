@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import math
+
+from starbound import sbon
+from starbound.btreedb5 import read_sidecar, write_sidecar
+
+
+EntityRecord = namedtuple('EntityRecord', [
+    'type',
+    'name',
+    'unique_id',
+    'position',
+    'region',
+    'index',
+])
+
+
+class EntityIndex(object):
+    """
+    The type, name, unique id and tile position of every entity in a world,
+    bucketed into a grid of `cell_size` tiles for fast area queries. Each
+    record also remembers the region and the entity's index within it, so
+    the full entity can be loaded with `World.get_entity` when needed.
+    """
+
+    MAGIC = b'PYENT1'
+
+    def __init__(self, records, signature=None, cell_size=64):
+        self.records = records
+        self.signature = signature
+        self.cell_size = cell_size
+        self.by_unique_id = {}
+        self.grid = {}
+        for record in records:
+            if record.unique_id is not None:
+                self.by_unique_id[record.unique_id] = record
+            if record.position is not None:
+                cell = (int(record.position[0] // cell_size),
+                        int(record.position[1] // cell_size))
+                self.grid.setdefault(cell, []).append(record)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, type=None, name=None):
+        """
+        Returns the records that match the given entity type (e.g.,
+        `'ObjectEntity'`) and/or name (e.g., `'woodencrate'`).
+        """
+        return [record for record in self.records
+                if (type is None or record.type == type) and
+                   (name is None or record.name == name)]
+
+    def in_bbox(self, min_x, min_y, max_x, max_y):
+        """
+        Returns the records of entities whose position is within the given
+        box of tile coordinates (the max coordinates are exclusive).
+        """
+        size = self.cell_size
+        records = []
+        for cx in range(int(min_x // size), int(math.ceil(max_x / float(size)))):
+            for cy in range(int(min_y // size), int(math.ceil(max_y / float(size)))):
+                for record in self.grid.get((cx, cy), ()):
+                    x, y = record.position
+                    if min_x <= x < max_x and min_y <= y < max_y:
+                        records.append(record)
+        return records
+
+    def in_radius(self, x, y, radius):
+        """
+        Returns the records of entities within `radius` tiles of the given
+        position, closest first.
+        """
+        records = []
+        for record in self.in_bbox(x - radius, y - radius, x + radius + 1, y + radius + 1):
+            distance = math.hypot(record.position[0] - x, record.position[1] - y)
+            if distance <= radius:
+                records.append((distance, record))
+        records.sort(key=lambda pair: pair[0])
+        return [record for _, record in records]
+
+    @classmethod
+    def load(cls, path):
+        signature, data, offset = read_sidecar(path, cls.MAGIC)
+        rows, _ = sbon.loads(data, offset)
+        records = []
+        for entity_type, name, unique_id, x, y, rx, ry, index in rows:
+            position = None if x is None else (x, y)
+            records.append(EntityRecord(entity_type, name, unique_id, position, (rx, ry), index))
+        return cls(records, signature)
+
+    def save(self, path):
+        rows = []
+        for record in self.records:
+            x, y = record.position or (None, None)
+            rows.append([record.type, record.name, record.unique_id, x, y,
+                         record.region[0], record.region[1], record.index])
+        write_sidecar(path, self.MAGIC, self.signature, [sbon.dumps(rows)])
+
+
+def entity_position(data):
+    """
+    Returns the tile position of an entity from its data, or `None` if it
+    can't be found. Objects have a `tilePosition` while most other entities
+    store their position in their movement controller.
+    """
+    for container, key in ((data, 'tilePosition'), (data, 'position'),
+                           (data.get('movementController'), 'position')):
+        try:
+            position = container[key]
+            if len(position) == 2:
+                return (position[0], position[1])
+        except (KeyError, TypeError):
+            pass
+    return None
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import os.path
+import struct
+import zlib
+
+import starbound
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Material ids from this one and up are "meta" materials (empty space, not
+# generated yet, etc.) which aren't drawn.
+FIRST_META_MATERIAL = 65520
+
+# Collision kinds that are drawn by the collision overlay, and their colors.
+COLLISION_COLORS = {
+    2: (255, 220, 0),  # Platform
+    3: (0, 220, 255),  # Dynamic
+    4: (255, 0, 255),  # Slippery
+    5: (255, 0, 0),    # Block
+}
+
+# Layers drawn by default, from the bottom up.
+DEFAULT_LAYERS = ('background', 'foreground', 'liquid')
+
+_palettes = {}
+
+
+class PNGWriter(object):
+    """
+    Writes an 8-bit RGB PNG image to a stream one batch of rows at a time, so
+    the whole image never has to be in memory.
+    """
+
+    def __init__(self, stream, width, height, compression=6):
+        self.stream = stream
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compression)
+        self._pending = []
+        self._pending_size = 0
+        stream.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def close(self):
+        assert self.rows_written == self.height, 'Not all rows were written'
+        self._pending.append(self._compressor.flush())
+        self._write_chunk(b'IDAT', b''.join(self._pending))
+        self._pending = []
+        self._write_chunk(b'IEND', b'')
+
+    def write_rows(self, rows):
+        """
+        Writes rows from a `(rows, width, 3)` array of `uint8` colors.
+        """
+        assert rows.shape[1:] == (self.width, 3), 'Invalid row shape'
+        assert self.rows_written + len(rows) <= self.height, 'Too many rows'
+        # Each row is prefixed with its filter type (0 means no filter).
+        data = numpy.zeros((len(rows), self.width * 3 + 1), dtype=numpy.uint8)
+        data[:, 1:] = rows.reshape(len(rows), -1)
+        compressed = self._compressor.compress(data.tobytes())
+        self.rows_written += len(rows)
+        if compressed:
+            self._pending.append(compressed)
+            self._pending_size += len(compressed)
+        # Write the compressed data in chunks of a reasonable size.
+        if self._pending_size >= 65536:
+            self._write_chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _write_chunk(self, kind, data):
+        self.stream.write(struct.pack('>I', len(data)))
+        self.stream.write(kind)
+        self.stream.write(data)
+        self.stream.write(struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+
+def build_tile_pyramid(world, directory, tile_size=256, scale=8,
+                       layers=DEFAULT_LAYERS, collision=False, workers=None):
+    """
+    Renders the world as a pyramid of `tile_size` pixel PNG tiles for
+    zoomable ("slippy") maps, stored as `<directory>/<z>/<x>/<y>.png`. Zoom
+    level 0 is a single tile showing the whole world. At the highest zoom
+    level each tile pixel is one `scale`th of a world tile, and every zoom
+    level below that is downsampled from the one above it.
+
+    A hash of every region's data is kept in `pyramid.json` in the
+    directory, so running this again for the same world only re-renders the
+    tiles that show regions that changed. Returns the number of tiles that
+    were rendered. Requires NumPy.
+    """
+    if numpy is None:
+        raise ImportError('NumPy is required for rendering')
+    assert tile_size % scale == 0 and tile_size // scale % 32 == 0, \
+        'Tiles must cover a whole number of regions'
+    if not hasattr(world, 'width'):
+        world.read_metadata()
+    # Number of world tiles per side of a tile at the highest zoom level.
+    span = tile_size // scale
+    columns = -(-world.width // span)
+    rows = -(-world.height // span)
+    max_zoom = 0
+    while 1 << max_zoom < max(columns, rows):
+        max_zoom += 1
+    manifest_path = os.path.join(directory, 'pyramid.json')
+    options = {
+        'collision': collision,
+        'layers': list(layers),
+        'scale': scale,
+        'size': [world.width, world.height],
+        'tile_size': tile_size,
+    }
+    regions = {}
+    for key, data in world.prefix_items(b'\x01'):
+        _, rx, ry = struct.unpack('>BHH', key)
+        regions['{},{}'.format(rx, ry)] = hashlib.sha1(data).hexdigest()
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        manifest = None
+    if manifest is None or manifest.get('options') != options:
+        dirty = set((x, y) for x in range(columns) for y in range(rows))
+    else:
+        # Find the tiles showing regions that were added, removed or changed.
+        old_regions = manifest.get('regions', {})
+        dirty = set()
+        for coords in set(regions) | set(old_regions):
+            if regions.get(coords) != old_regions.get(coords):
+                rx, ry = (int(v) for v in coords.split(','))
+                dirty.add((rx * 32 // span, rows - 1 - ry * 32 // span))
+    import concurrent.futures
+    workers = workers or multiprocessing.cpu_count()
+    pool = concurrent.futures.ThreadPoolExecutor(workers)
+    rendered = 0
+    try:
+        render = functools.partial(_render_base_tile, world, directory, max_zoom,
+                                   rows, span, layers, collision, scale)
+        for _ in pool.map(render, sorted(dirty)):
+            rendered += 1
+        # Each tile on the level below is made from four tiles of this one.
+        for zoom in range(max_zoom - 1, -1, -1):
+            dirty = set((x // 2, y // 2) for x, y in dirty)
+            downsample = functools.partial(_downsample_tile, directory, zoom, tile_size)
+            for _ in pool.map(downsample, sorted(dirty)):
+                rendered += 1
+    finally:
+        pool.shutdown()
+    # Only store the hashes once all the tiles have been written.
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'options': options, 'regions': regions}, f, sort_keys=True)
+    getattr(os, 'replace', os.rename)(temp_path, manifest_path)
+    return rendered
+
+
+def palette(kind):
+    """
+    Returns a lookup table with an RGB color for every possible value of a
+    tile field, as a `(65536, 3)` array for `'material'` and a `(256, 3)`
+    array for `'liquid'`. Each value gets a color from a fixed hash of the
+    value, so the same material always has the same color.
+    """
+    if kind in _palettes:
+        return _palettes[kind]
+    size = 65536 if kind == 'material' else 256
+    values = numpy.arange(size, dtype=numpy.uint32)
+    # Knuth's multiplicative hash spreads out neighbouring values.
+    hashed = values * numpy.uint32(2654435761)
+    colors = numpy.empty((size, 3), dtype=numpy.uint8)
+    for channel, shift in enumerate((24, 16, 8)):
+        # Stay away from black, which is used for empty space.
+        colors[:, channel] = 48 + ((hashed >> shift) & 0xFF) * 207 // 255
+    if kind == 'liquid':
+        # Water and lava get their usual colors.
+        colors[1] = (40, 90, 230)
+        colors[2] = (250, 110, 20)
+    _palettes[kind] = colors
+    return colors
+
+
+def read_png(stream):
+    """
+    Reads an image written by `PNGWriter` back into a `(height, width, 3)`
+    array. Only unfiltered 8-bit RGB images are supported.
+    """
+    assert stream.read(8) == b'\x89PNG\r\n\x1a\n', 'Not a PNG image'
+    decompressor = zlib.decompressobj()
+    data = []
+    while True:
+        length, kind = struct.unpack('>I4s', stream.read(8))
+        chunk = stream.read(length)
+        stream.read(4)
+        if kind == b'IHDR':
+            width, height, depth, color_type = struct.unpack('>IIBB', chunk[:10])
+            assert (depth, color_type) == (8, 2), 'Only 8-bit RGB is supported'
+        elif kind == b'IDAT':
+            data.append(decompressor.decompress(chunk))
+        elif kind == b'IEND':
+            break
+    rows = numpy.frombuffer(b''.join(data), dtype=numpy.uint8).reshape(height, width * 3 + 1)
+    assert not rows[:, 0].any(), 'Only unfiltered rows are supported'
+    return rows[:, 1:].reshape(height, width, 3)
+
+
+def render_tiles(tiles, layers=DEFAULT_LAYERS, collision=False):
+    """
+    Turns an array of tiles (e.g., from `World.get_tiles_array` or
+    `World.get_tile_grid`) into an array of RGB colors with the same shape
+    plus a trailing axis of 3. The layers are drawn in the given order, any
+    of `'background'` (drawn darker), `'foreground'` and `'liquid'`. If
+    `collision` is true, the collision kind of each tile is drawn on top.
+    Note that the rows keep the same order as the tiles, with Y going up.
+    """
+    materials = palette('material')
+    image = numpy.zeros(tiles.shape + (3,), dtype=numpy.uint8)
+    for layer in layers:
+        if layer in ('background', 'foreground'):
+            ids = tiles[layer + '_material'].astype(numpy.uint16)
+            mask = ids < FIRST_META_MATERIAL
+            colors = materials[ids[mask]]
+            if layer == 'background':
+                colors = colors // 2
+            image[mask] = colors
+        elif layer == 'liquid':
+            mask = tiles['liquid'] != 0
+            alpha = numpy.clip(tiles['liquid_level'][mask], 0, 1)[:, None] * .7
+            colors = palette('liquid')[tiles['liquid'][mask]]
+            image[mask] = image[mask] * (1 - alpha) + colors * alpha
+        else:
+            raise ValueError('Unknown layer {!r}'.format(layer))
+    if collision:
+        for kind, color in COLLISION_COLORS.items():
+            mask = tiles['collision'] == kind
+            image[mask] = image[mask] * .6 + numpy.array(color) * .4
+    return image
+
+
+def render_world(world, stream, bbox=None, layers=DEFAULT_LAYERS,
+                 collision=False, scale=1, workers=None):
+    """
+    Renders the world (or the `(min_x, min_y, max_x, max_y)` tile bounding
+    box of it) as a PNG image written to `stream`, with `scale` pixels per
+    tile. The image is rendered in bands of one row of regions, which are
+    rendered in a pool of `workers` threads and written out in order, so
+    memory use doesn't depend on the size of the world. Returns the width
+    and height of the image. Requires NumPy.
+    """
+    if numpy is None:
+        raise ImportError('NumPy is required for rendering')
+    if not hasattr(world, 'width'):
+        world.read_metadata()
+    min_x, min_y, max_x, max_y = bbox or (0, 0, world.width, world.height)
+    min_x, min_y = max(min_x, 0), max(min_y, 0)
+    max_x, max_y = min(max_x, world.width), min(max_y, world.height)
+    width, height = max(max_x - min_x, 0) * scale, max(max_y - min_y, 0) * scale
+    if not width or not height:
+        raise ValueError('Nothing to render in {}'.format((min_x, min_y, max_x, max_y)))
+    writer = PNGWriter(stream, width, height)
+    workers = workers or multiprocessing.cpu_count()
+    # Images go from the top down, but Y goes up in the world.
+    bands = ((world, (min_x, max(ry * 32, min_y), max_x, min(ry * 32 + 32, max_y)),
+              layers, collision, scale)
+             for ry in range((max_y - 1) // 32, min_y // 32 - 1, -1))
+    # Bands are large, so keep fewer of them in flight than usual.
+    for rows in starbound._imap_bounded(_render_band, bands, workers,
+                                        max_pending=workers * 2):
+        writer.write_rows(rows)
+    writer.close()
+    return width, height
+
+
+def _downsample_tile(directory, zoom, tile_size, coords):
+    x, y = coords
+    image = numpy.zeros((tile_size * 2, tile_size * 2, 3), dtype=numpy.uint8)
+    for dx in range(2):
+        for dy in range(2):
+            path = _tile_path(directory, zoom + 1, x * 2 + dx, y * 2 + dy)
+            if not os.path.exists(path):
+                # Tiles outside the world are left black.
+                continue
+            with open(path, 'rb') as f:
+                image[dy * tile_size:(dy + 1) * tile_size,
+                      dx * tile_size:(dx + 1) * tile_size] = read_png(f)
+    # Average every 2×2 block of pixels.
+    image = image.reshape(tile_size, 2, tile_size, 2, 3).mean(axis=(1, 3))
+    _write_tile(directory, zoom, x, y, image.astype(numpy.uint8))
+
+
+def _render_base_tile(world, directory, zoom, rows, span, layers, collision, scale, coords):
+    x, y = coords
+    # The map starts at the top of the world, but Y goes up in the world.
+    min_x, min_y = x * span, (rows - 1 - y) * span
+    tiles = numpy.empty((span, span), dtype=starbound.TILE_DTYPE)
+    tiles[...] = tuple(starbound.NOT_GENERATED_TILE)
+    grid = world.get_tile_grid(bbox=(min_x, min_y, min_x + span, min_y + span))
+    tiles[:grid.shape[0], :grid.shape[1]] = grid
+    image = render_tiles(tiles, layers, collision)[::-1]
+    if scale > 1:
+        image = image.repeat(scale, axis=0).repeat(scale, axis=1)
+    _write_tile(directory, zoom, x, y, image)
+
+
+def _render_band(world, bbox, layers, collision, scale):
+    min_x, min_y, max_x, max_y = bbox
+    tiles = numpy.empty((max_y - min_y, max_x - min_x), dtype=starbound.TILE_DTYPE)
+    tiles[...] = tuple(starbound.NOT_GENERATED_TILE)
+    ry = min_y // 32
+    coords = [(rx, ry) for rx in range(min_x // 32, (max_x - 1) // 32 + 1)]
+    for (rx, _), data in world.get_many(1, coords).items():
+        region = world.read_tiles_array(data)
+        x0, x1 = max(rx * 32, min_x), min(rx * 32 + 32, max_x)
+        tiles[:, x0 - min_x:x1 - min_x] = \
+            region[min_y - ry * 32:max_y - ry * 32, x0 - rx * 32:x1 - rx * 32]
+    image = render_tiles(tiles, layers, collision)[::-1]
+    if scale > 1:
+        image = image.repeat(scale, axis=0).repeat(scale, axis=1)
+    return image
+
+
+def _tile_path(directory, zoom, x, y):
+    return os.path.join(directory, str(zoom), str(x), '{}.png'.format(y))
+
+
+def _write_tile(directory, zoom, x, y, image):
+    path = _tile_path(directory, zoom, x, y)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        # The directory already exists.
+        pass
+    with open(path, 'wb') as f:
+        writer = PNGWriter(f, image.shape[1], image.shape[0])
+        writer.write_rows(image)
+        writer.close()
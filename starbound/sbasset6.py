@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 
+from array import array
 from collections import namedtuple
+import fnmatch
+import functools
+import os
+import os.path
 import struct
+import threading
 
 from starbound import sbon
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 
 # Override range with xrange when running Python 2.x.
 try:
@@ -17,19 +28,154 @@ HEADER = '>8sQ'
 HEADER_SIZE = struct.calcsize(HEADER)
 
 
+# Python 2 has no 64-bit array type, so offsets are kept in lists there.
+try:
+    array('Q')
+    _offset_array = functools.partial(array, 'Q')
+except ValueError:
+    _offset_array = list
+
+
 IndexEntry = namedtuple('IndexEntry', ['offset', 'length'])
 
 
+class AssetIndex(Mapping):
+    """
+    A read-only mapping of (lowercased) paths to `IndexEntry` tuples. To keep
+    memory use down for large packages, each path only maps to a slot in the
+    `offsets` and `lengths` arrays.
+    """
+
+    def __init__(self, paths, offsets, lengths):
+        self.paths = paths
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __getitem__(self, path):
+        slot = self.paths[path]
+        return IndexEntry(self.offsets[slot], self.lengths[slot])
+
+    def __iter__(self):
+        return iter(self.paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+
 class SBAsset6(object):
     def __init__(self, stream):
         self.stream = stream
+        # If the stream supports the buffer protocol (e.g., an mmap), files
+        # are sliced directly out of it instead of being seeked and read. As
+        # in `BTreeDB5`, a new view is made for every read.
+        try:
+            memoryview(stream)
+            self.is_buffer = True
+        except TypeError:
+            self.is_buffer = False
+        # Otherwise `os.pread` is used if the stream is a real file.
+        self._fileno = None
+        if not self.is_buffer and hasattr(os, 'pread'):
+            try:
+                self._fileno = stream.fileno()
+            except (AttributeError, IOError, ValueError):
+                pass
+        # Guards the stream position when neither of the above is possible.
+        self._lock = threading.Lock()
+
+    def extract_all(self, destination, workers=None, pattern=None,
+                    callback=None, chunk_size=1024 * 1024):
+        """
+        Extracts all files in the package (or only those with paths matching
+        the glob `pattern`, see `find_paths`) into the `destination`
+        directory, using a pool of `workers` threads. Files are extracted in
+        the order they're stored in the package and written in chunks of at
+        most `chunk_size` bytes. If given, `callback(path, error)` is called
+        as each file finishes, with `error` set to the exception if the file
+        failed (errors are raised if there is no callback). Returns the
+        number of extracted files. Requires `concurrent.futures` (the
+        `futures` backport on Python 2).
+        """
+        import concurrent.futures
+        if not hasattr(self, 'index'):
+            self.read_index()
+        root = os.path.abspath(destination)
+        entries = []
+        directories = set()
+        if pattern is None:
+            paths = self.index
+        else:
+            paths = self.find_paths(pattern)
+        for path in paths:
+            entry = self.index[path]
+            dest_path = os.path.normpath(os.path.join(root, path.lstrip('/')))
+            if not dest_path.startswith(root + os.sep):
+                raise ValueError('Unsafe path in package: {}'.format(path))
+            entries.append((entry.offset, entry.length, path, dest_path))
+            directories.add(os.path.dirname(dest_path))
+        # Create the whole directory tree before extracting anything.
+        for directory in sorted(directories):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        entries.sort()
+        num_files = 0
+        with concurrent.futures.ThreadPoolExecutor(workers or 4) as pool:
+            futures = [(path, pool.submit(self._extract_file, offset, length, dest_path, chunk_size))
+                       for offset, length, path, dest_path in entries]
+            for path, future in futures:
+                error = future.exception()
+                if error is None:
+                    num_files += 1
+                elif callback is None:
+                    raise error
+                if callback is not None:
+                    callback(path, error)
+        return num_files
+
+    def find_paths(self, pattern):
+        """
+        Returns a sorted list of the paths in the package that match the glob
+        `pattern` (e.g., `'/items/*.item'`). Like the rest of the index, the
+        matching ignores case.
+        """
+        if not hasattr(self, 'index'):
+            self.read_index()
+        pattern = pattern.lower()
+        return sorted(path for path in self.index if fnmatch.fnmatchcase(path, pattern))
 
     def get(self, path):
         if not hasattr(self, 'index'):
             self.read_index()
         offset, length = self.index[path.lower()]
-        self.stream.seek(offset)
-        return self.stream.read(length)
+        data = self.read_at(offset, length)
+        return data.tobytes() if isinstance(data, memoryview) else data
+
+    def get_view(self, path):
+        """
+        Returns a memoryview of the file at the given path. If the package was
+        opened from a buffer, no data is copied.
+        """
+        if not hasattr(self, 'index'):
+            self.read_index()
+        offset, length = self.index[path.lower()]
+        data = self.read_at(offset, length)
+        return data if isinstance(data, memoryview) else memoryview(data)
+
+    def read_at(self, offset, length):
+        """
+        Reads `length` bytes at `offset` without relying on the stream
+        position, so it's safe to call from multiple threads.
+        """
+        if self.is_buffer:
+            return memoryview(self.stream)[offset:offset + length]
+        if self._fileno is not None:
+            return os.pread(self._fileno, length, offset)
+        with self._lock:
+            self.stream.seek(offset)
+            return self.stream.read(length)
 
     def read_header(self):
         self.stream.seek(0)
@@ -47,9 +193,35 @@ class SBAsset6(object):
     def read_index(self):
         if not hasattr(self, 'index_offset'):
             self.read_header()
-        self.stream.seek(self.index_offset)
-        self.index = {}
-        for i in range(self.file_count):
-            path = sbon.read_string(self.stream).lower()
-            offset, length = struct.unpack('>QQ', self.stream.read(16))
-            self.index[path] = IndexEntry(offset, length)
+        # Decode the whole index from a single buffer.
+        if self.is_buffer:
+            data = memoryview(self.stream)[self.index_offset:]
+        else:
+            # Not all streams can read to the end (e.g., mmaps on Python 2).
+            self.stream.seek(0, 2)
+            size = self.stream.tell() - self.index_offset
+            self.stream.seek(self.index_offset)
+            data = self.stream.read(size)
+        # Make the data indexable once up front, rather than once per path
+        # as `sbon.loads_string` would (which copies it on Python 2).
+        data = sbon._indexable(data)
+        loads_string = sbon._loads_string
+        paths = {}
+        offsets = _offset_array()
+        lengths = _offset_array()
+        unpack_entry = struct.Struct('>QQ').unpack_from
+        offset = 0
+        for slot in range(self.file_count):
+            path, offset = loads_string(data, offset)
+            file_offset, file_length = unpack_entry(data, offset)
+            offset += 16
+            paths[path.lower()] = slot
+            offsets.append(file_offset)
+            lengths.append(file_length)
+        self.index = AssetIndex(paths, offsets, lengths)
+
+    def _extract_file(self, offset, length, dest_path, chunk_size):
+        with open(dest_path, 'wb') as f:
+            end = offset + length
+            for start in range(offset, end, chunk_size):
+                f.write(self.read_at(start, min(chunk_size, end - start)))
@@ -1,15 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import codecs
 import struct
 import sys
 
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
 
 if sys.version >= '3':
     _int_type = int
     _str_type = str
 
-    def _byte(x):
-        return bytes((x,))
+    _bytes = bytes
+
+    def _indexable(buf):
+        return buf
 
     def _items(d):
         return d.items()
@@ -18,13 +26,183 @@ else:
     _str_type = basestring
     range = xrange
 
-    def _byte(x):
-        return chr(x)
+    def _bytes(buf):
+        # `bytes(memoryview)` gives the repr of the view in 2.x.
+        return buf.tobytes() if isinstance(buf, memoryview) else bytes(buf)
+
+    def _indexable(buf):
+        # Indexing str and buffers gives characters instead of ints in 2.x.
+        return buf if isinstance(buf, bytearray) else bytearray(buf)
 
     def _items(d):
         return d.iteritems()
 
 
+_decode_utf8 = codecs.utf_8_decode
+_pack_double = struct.Struct('>d').pack
+_unpack_double = struct.Struct('>d').unpack_from
+
+
+def dumps(value):
+    """Encode a value as an SBON dynamic and return the resulting bytes.
+
+    """
+    out = bytearray()
+    _dump_dynamic(out, value)
+    return bytes(out)
+
+
+def dumps_string(value):
+    """Like `dumps`, but for a string without a type prefix."""
+    out = bytearray()
+    _dump_string(out, value)
+    return bytes(out)
+
+
+def dumps_varint(value):
+    """Like `dumps`, but for an unsigned varint without a type prefix."""
+    out = bytearray()
+    _dump_varint(out, value)
+    return bytes(out)
+
+
+def loads(buf, offset=0):
+    """Decode the dynamic value starting at `offset` in a bytes-like object
+    (e.g., bytes or a memoryview). Returns a `(value, end_offset)` tuple.
+
+    """
+    return _loads_dynamic(_indexable(buf), offset)
+
+
+def loads_lazy(buf, offset=0):
+    """Like `loads`, but maps and lists are returned as `SBONMap` and
+    `SBONList` views which only decode their contents when accessed. The
+    views keep a reference to `buf`.
+
+    """
+    buf = _indexable(buf)
+    return _loads_lazy(buf, offset), _skip_dynamic(buf, offset)
+
+
+def loads_string(buf, offset=0):
+    """Like `loads`, but for a string without a type prefix."""
+    return _loads_string(_indexable(buf), offset)
+
+
+def loads_varint(buf, offset=0):
+    """Like `loads`, but for an unsigned varint without a type prefix."""
+    return _loads_varint(_indexable(buf), offset)
+
+
+class SBONMap(Mapping):
+    """A read-only mapping over an SBON map in a buffer. The offsets of the
+    values are recorded the first time the map is accessed, and each value
+    is only decoded once it's looked up. Nested maps and lists are views as
+    well. Use `to_dict` to decode the whole map into a regular dict.
+
+    """
+
+    def __init__(self, buf, offset):
+        # The offset is that of the map's type byte.
+        self._buf = buf
+        self._offset = offset
+        self._index = None
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = _loads_lazy(self._buf, self._get_index()[key])
+        self._values[key] = value
+        return value
+
+    def __iter__(self):
+        return iter(self._get_index())
+
+    def __len__(self):
+        return len(self._get_index())
+
+    def __repr__(self):
+        return 'SBONMap(%r)' % (self.to_dict(),)
+
+    def to_dict(self):
+        return _loads_dynamic(self._buf, self._offset)[0]
+
+    def _get_index(self):
+        if self._index is None:
+            buf = self._buf
+            length, offset = _loads_varint(buf, self._offset + 1)
+            index = dict()
+            for _ in range(length):
+                key, offset = _loads_string(buf, offset)
+                index[key] = offset
+                offset = _skip_dynamic(buf, offset)
+            self._index = index
+        return self._index
+
+
+class SBONList(Sequence):
+    """A read-only sequence over an SBON list in a buffer, which decodes its
+    items as they're accessed (see `SBONMap`). Use `to_list` to decode the
+    whole list into a regular list.
+
+    """
+
+    def __init__(self, buf, offset):
+        # The offset is that of the list's type byte.
+        self._buf = buf
+        self._offset = offset
+        self._offsets = None
+        self._values = {}
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence) or isinstance(other, _str_type):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        offsets = self._get_offsets()
+        if index < 0:
+            index += len(offsets)
+        try:
+            return self._values[index]
+        except KeyError:
+            pass
+        if not 0 <= index < len(offsets):
+            raise IndexError('list index out of range')
+        value = _loads_lazy(self._buf, offsets[index])
+        self._values[index] = value
+        return value
+
+    def __len__(self):
+        return len(self._get_offsets())
+
+    def __repr__(self):
+        return 'SBONList(%r)' % (self.to_list(),)
+
+    def to_list(self):
+        return _loads_dynamic(self._buf, self._offset)[0]
+
+    def _get_offsets(self):
+        if self._offsets is None:
+            buf = self._buf
+            length, offset = _loads_varint(buf, self._offset + 1)
+            offsets = []
+            for _ in range(length):
+                offsets.append(offset)
+                offset = _skip_dynamic(buf, offset)
+            self._offsets = offsets
+        return self._offsets
+
+
 def read_bytes(stream):
     length = read_varint(stream)
     return stream.read(length)
@@ -95,27 +273,7 @@ def write_bytes(stream, value):
 
 
 def write_dynamic(stream, value):
-    if value is None:
-        stream.write(b'\x01')
-    elif isinstance(value, float):
-        stream.write(b'\x02')
-        stream.write(struct.pack('>d', value))
-    elif isinstance(value, bool):
-        stream.write(b'\x03\x01' if value else b'\x03\x00')
-    elif isinstance(value, _int_type):
-        stream.write(b'\x04')
-        write_varint_signed(stream, value)
-    elif isinstance(value, _str_type):
-        stream.write(b'\x05')
-        write_string(stream, value)
-    elif isinstance(value, list):
-        stream.write(b'\x06')
-        write_list(stream, value)
-    elif isinstance(value, dict):
-        stream.write(b'\x07')
-        write_map(stream, value)
-    else:
-        raise ValueError('Cannot write value %r' % (value,))
+    stream.write(dumps(value))
 
 
 def write_list(stream, value):
@@ -136,13 +294,206 @@ def write_string(stream, value):
 
 
 def write_varint(stream, value):
-    buf = _byte(value & 0b01111111)
-    value >>= 7
-    while value:
-        buf = _byte(value & 0b01111111 | 0b10000000) + buf
-        value >>= 7
-    stream.write(buf)
+    stream.write(dumps_varint(value))
 
 
 def write_varint_signed(stream, value):
     write_varint(stream, (-(value + 1) << 1 | 1) if value < 0 else (value << 1))
+
+
+def _dump_dynamic(out, value):
+    # Exact type checks come first since they're cheaper than isinstance,
+    # the fallbacks below handle subclasses (and 2.x types) in the same
+    # order as `write_dynamic` originally did.
+    value_type = type(value)
+    if value_type is str:
+        out.append(5)
+        _dump_string(out, value)
+    elif value_type is dict:
+        out.append(7)
+        _dump_varint(out, len(value))
+        for k, v in _items(value):
+            _dump_string(out, k)
+            _dump_dynamic(out, v)
+    elif value_type is int:
+        out.append(4)
+        _dump_varint(out, (-(value + 1) << 1 | 1) if value < 0 else (value << 1))
+    elif value_type is list:
+        out.append(6)
+        _dump_varint(out, len(value))
+        for v in value:
+            _dump_dynamic(out, v)
+    elif value_type is float:
+        out.append(2)
+        out += _pack_double(value)
+    elif value_type is bool:
+        out += b'\x03\x01' if value else b'\x03\x00'
+    elif value is None:
+        out.append(1)
+    elif isinstance(value, float):
+        out.append(2)
+        out += _pack_double(value)
+    elif isinstance(value, bool):
+        out += b'\x03\x01' if value else b'\x03\x00'
+    elif isinstance(value, _int_type):
+        out.append(4)
+        _dump_varint(out, (-(value + 1) << 1 | 1) if value < 0 else (value << 1))
+    elif isinstance(value, _str_type):
+        out.append(5)
+        _dump_string(out, value)
+    elif isinstance(value, list):
+        out.append(6)
+        _dump_varint(out, len(value))
+        for v in value:
+            _dump_dynamic(out, v)
+    elif isinstance(value, dict):
+        out.append(7)
+        _dump_varint(out, len(value))
+        for k, v in _items(value):
+            _dump_string(out, k)
+            _dump_dynamic(out, v)
+    else:
+        raise ValueError('Cannot write value %r' % (value,))
+
+
+def _dump_string(out, value):
+    data = value.encode('utf-8')
+    _dump_varint(out, len(data))
+    out += data
+
+
+def _dump_varint(out, value):
+    if value < 0b10000000:
+        out.append(value)
+        return
+    # Write the 7 bit groups from most to least significant.
+    shift = (value.bit_length() - 1) // 7 * 7
+    while shift:
+        out.append(value >> shift & 0b01111111 | 0b10000000)
+        shift -= 7
+    out.append(value & 0b01111111)
+
+
+def _loads_dynamic(buf, offset):
+    # The most common types are checked first, and scalars inside lists and
+    # maps are decoded inline since function calls dominate the decode time.
+    type_id = buf[offset]
+    offset += 1
+    if type_id == 5:
+        return _loads_string(buf, offset)
+    elif type_id == 7:
+        length = buf[offset]
+        if length & 0b10000000:
+            length, offset = _loads_varint(buf, offset)
+        else:
+            offset += 1
+        value = dict()
+        for _ in range(length):
+            size = buf[offset]
+            if size & 0b10000000:
+                size, offset = _loads_varint(buf, offset)
+            else:
+                offset += 1
+            end = offset + size
+            key = _decode_utf8(buf[offset:end])[0]
+            type_id = buf[end]
+            if type_id == 5:
+                value[key], offset = _loads_string(buf, end + 1)
+            elif type_id == 4 and not buf[end + 1] & 0b10000000:
+                number = buf[end + 1]
+                value[key] = -(number >> 1) - 1 if number & 1 else number >> 1
+                offset = end + 2
+            else:
+                value[key], offset = _loads_dynamic(buf, end)
+        return value, offset
+    elif type_id == 6:
+        length = buf[offset]
+        if length & 0b10000000:
+            length, offset = _loads_varint(buf, offset)
+        else:
+            offset += 1
+        value = []
+        append = value.append
+        for _ in range(length):
+            type_id = buf[offset]
+            if type_id == 4 and not buf[offset + 1] & 0b10000000:
+                number = buf[offset + 1]
+                append(-(number >> 1) - 1 if number & 1 else number >> 1)
+                offset += 2
+            elif type_id == 2:
+                append(_unpack_double(buf, offset + 1)[0])
+                offset += 9
+            else:
+                item, offset = _loads_dynamic(buf, offset)
+                append(item)
+        return value, offset
+    elif type_id == 4:
+        value, offset = _loads_varint(buf, offset)
+        return (-(value >> 1) - 1 if value & 1 else value >> 1), offset
+    elif type_id == 2:
+        return _unpack_double(buf, offset)[0], offset + 8
+    elif type_id == 3:
+        return buf[offset] != 0, offset + 1
+    elif type_id == 1:
+        return None, offset
+    raise ValueError('Unknown dynamic type 0x%02X' % type_id)
+
+
+def _loads_lazy(buf, offset):
+    type_id = buf[offset]
+    if type_id == 7:
+        return SBONMap(buf, offset)
+    elif type_id == 6:
+        return SBONList(buf, offset)
+    return _loads_dynamic(buf, offset)[0]
+
+
+def _loads_string(buf, offset):
+    length = buf[offset]
+    if length & 0b10000000:
+        length, offset = _loads_varint(buf, offset)
+    else:
+        offset += 1
+    end = offset + length
+    return _decode_utf8(buf[offset:end])[0], end
+
+
+def _loads_varint(buf, offset):
+    value = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        if not byte & 0b10000000:
+            return value << 7 | byte, offset
+        value = value << 7 | (byte & 0b01111111)
+
+
+def _skip_dynamic(buf, offset):
+    # Returns the offset right after the dynamic value at `offset`.
+    type_id = buf[offset]
+    offset += 1
+    if type_id == 5:
+        length, offset = _loads_varint(buf, offset)
+        return offset + length
+    elif type_id == 7:
+        length, offset = _loads_varint(buf, offset)
+        for _ in range(length):
+            size, offset = _loads_varint(buf, offset)
+            offset = _skip_dynamic(buf, offset + size)
+        return offset
+    elif type_id == 6:
+        length, offset = _loads_varint(buf, offset)
+        for _ in range(length):
+            offset = _skip_dynamic(buf, offset)
+        return offset
+    elif type_id == 4:
+        while buf[offset] & 0b10000000:
+            offset += 1
+        return offset + 1
+    elif type_id == 2:
+        return offset + 8
+    elif type_id == 3:
+        return offset + 1
+    elif type_id == 1:
+        return offset
+    raise ValueError('Unknown dynamic type 0x%02X' % type_id)
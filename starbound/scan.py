@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import struct
+import zlib
+
+import starbound
+
+
+# Offset of the dungeon id within a tile, after the 3 bytes at the start of
+# each region.
+_DUNGEON_ID_OFFSET = 3 + 25
+
+QUERY_TYPES = ('dungeon', 'dungeon_tiles', 'entity')
+
+
+def scan_universe(paths, queries, workers=None, skip=None):
+    """
+    Runs the queries on every world file in `paths` in a pool of `workers`
+    processes, and yields the result of `scan_world` for each file as soon
+    as it's done (so not necessarily in order). Files for which `skip`
+    returns true are not scanned, which can be used to resume a scan.
+    Requires `concurrent.futures` (the `futures` backport on Python 2).
+    """
+    arguments = ((path, queries) for path in paths
+                 if skip is None or not skip(path))
+    return starbound._imap_bounded(scan_world, arguments, workers,
+                                   executor='process', ordered=False)
+
+
+def scan_world(path, queries):
+    """
+    Runs a list of `(type, argument)` queries on the world file at `path`
+    and returns a dict with the `path`, `size` and `mtime` of the file, and
+    either the `results` (keyed by `'type:argument'`) or an `error`. Only the
+    parts of the world that the queries need are read:
+
+    - `('dungeon', name)`: whether the world has the dungeon (metadata only).
+    - `('dungeon_tiles', dungeon_id)`: the number of tiles with the dungeon
+      id, e.g. 65532 for tiles placed by players (tile data only).
+    - `('entity', unique_id)`: the tile position of the entity, or `None`
+      (the unique id index, and the one region with the entity).
+    """
+    stat = os.stat(path)
+    record = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+    try:
+        with open(path, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        world = starbound.World(mm)
+        results = {}
+        for query_type, argument in queries:
+            if query_type == 'dungeon':
+                value = argument in world.info.dungeons
+            elif query_type == 'dungeon_tiles':
+                value = _count_dungeon_tiles(world, int(argument))
+            elif query_type == 'entity':
+                value = world.get_entity_uuid_coords(argument)
+                value = None if value is None else list(value)
+            else:
+                raise ValueError('Unknown query type {!r}'.format(query_type))
+            results['{}:{}'.format(query_type, argument)] = value
+        record['results'] = results
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+    return record
+
+
+def _count_dungeon_tiles(world, dungeon_id):
+    count = 0
+    for _, data in world.prefix_items(b'\x01'):
+        data = zlib.decompress(data)
+        if starbound.numpy is not None:
+            count += int((world.read_tiles_array(data)['dungeon_id'] == dungeon_id).sum())
+        else:
+            count += sum(1 for i in range(1024) if struct.unpack_from(
+                '>H', data, _DUNGEON_ID_OFFSET + i * 31)[0] == dungeon_id)
+    return count
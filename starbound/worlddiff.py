@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import io
+import struct
+import zlib
+
+import starbound
+
+
+WorldDiff = namedtuple('WorldDiff', [
+    'metadata_changed',
+    'added_regions',
+    'removed_regions',
+    'changed_regions',
+    'field_changes',
+    'added_entities',
+    'removed_entities',
+    'changed_entities',
+])
+
+
+def diff_worlds(a, b):
+    """
+    Compares two worlds (e.g., two backups of the same world) and returns a
+    `WorldDiff` describing what changed from `a` to `b`:
+
+    - `metadata_changed` is `True` if the world metadata differs.
+    - `added_regions` and `removed_regions` list the `(rx, ry)` coordinates
+      of regions with tile data in only one of the worlds.
+    - `changed_regions` maps `(rx, ry)` to a dict with the number of tiles
+      that changed for every `Tile` field that changed in that region.
+    - `field_changes` has the same counts, summed over all regions.
+    - `added_entities`, `removed_entities` and `changed_entities` list the
+      unique ids of entities that were added, removed, or changed (which
+      includes moving to another region).
+
+    Both key trees are scanned together and only the values that differ
+    byte for byte are decompressed and decoded.
+    """
+    added_regions, removed_regions = [], []
+    changed_regions, field_changes = {}, {}
+    metadata_changed = False
+    # Maps unique ids to `(rx, ry, entity)` for the changed regions.
+    entities_a, entities_b = {}, {}
+    for key, value_a, value_b in _changed_items(a, b):
+        layer, rx, ry = struct.unpack('>BHH', key)
+        coords = (rx, ry)
+        if layer == 0:
+            metadata_changed = True
+        elif layer == 1:
+            if value_a is None:
+                added_regions.append(coords)
+            elif value_b is None:
+                removed_regions.append(coords)
+            else:
+                counts = _diff_tiles(zlib.decompress(value_a), zlib.decompress(value_b))
+                if counts:
+                    changed_regions[coords] = counts
+                    for field, count in counts.items():
+                        field_changes[field] = field_changes.get(field, 0) + count
+        elif layer == 2:
+            for value, entities in ((value_a, entities_a), (value_b, entities_b)):
+                if value is None:
+                    continue
+                for entity in starbound.World.read_entities(zlib.decompress(value)):
+                    if 'uniqueId' in entity.data:
+                        entities[entity.data['uniqueId']] = coords + (entity,)
+    added_entities = sorted(set(entities_b) - set(entities_a))
+    removed_entities = sorted(set(entities_a) - set(entities_b))
+    changed_entities = sorted(uuid for uuid in set(entities_a) & set(entities_b)
+                              if entities_a[uuid] != entities_b[uuid])
+    return WorldDiff(metadata_changed, added_regions, removed_regions,
+                     changed_regions, field_changes,
+                     added_entities, removed_entities, changed_entities)
+
+
+def _changed_items(a, b):
+    # Walks the keys of both worlds in order and yields `(key, value_a,
+    # value_b)` for every key whose raw value differs (`None` if missing).
+    items_a, items_b = a.items(), b.items()
+    item_a, item_b = next(items_a, None), next(items_b, None)
+    while item_a is not None or item_b is not None:
+        if item_b is None or (item_a is not None and item_a[0] < item_b[0]):
+            yield item_a[0], item_a[1], None
+            item_a = next(items_a, None)
+        elif item_a is None or item_b[0] < item_a[0]:
+            yield item_b[0], None, item_b[1]
+            item_b = next(items_b, None)
+        else:
+            if item_a[1] != item_b[1]:
+                yield item_a[0], item_a[1], item_b[1]
+            item_a, item_b = next(items_a, None), next(items_b, None)
+
+
+def _diff_tiles(data_a, data_b):
+    # Returns a dict of the number of tiles that changed for each field.
+    if starbound.numpy is not None:
+        tiles_a = starbound.World.read_tiles_array(data_a)
+        tiles_b = starbound.World.read_tiles_array(data_b)
+        counts = ((field, int((tiles_a[field] != tiles_b[field]).sum()))
+                  for field in starbound.Tile._fields)
+    else:
+        tiles_a = starbound.World.read_tiles(io.BytesIO(data_a))
+        tiles_b = starbound.World.read_tiles(io.BytesIO(data_b))
+        counts = ((field, sum(1 for tile_a, tile_b in zip(tiles_a, tiles_b)
+                              if tile_a[i] != tile_b[i]))
+                  for i, field in enumerate(starbound.Tile._fields))
+    return dict((field, count) for field, count in counts if count)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+from starbound.btreedb5 import BTreeDB5, BTreeDB5Writer
+
+
+KEY_SIZE = 4
+BLOCK_SIZE = 512
+
+
+def make_key(i):
+    return struct.pack('>I', i)
+
+
+def make_value(rng, length=None):
+    if length is None:
+        length = rng.choice((0, 1, rng.randint(2, 100), rng.randint(100, 3 * BLOCK_SIZE)))
+    return bytes(bytearray(rng.getrandbits(8) for _ in range(length)))
+
+
+def as_bytes(value):
+    return value.tobytes() if isinstance(value, memoryview) else value
+
+
+def write_db(stream, items):
+    writer = BTreeDB5Writer(stream, u'Test', KEY_SIZE, block_size=BLOCK_SIZE)
+    for key, value in sorted(items.items()):
+        writer.add(key, value)
+    writer.finish()
+
+
+class WriterTest(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(1234)
+        self.expected = {make_key(i * 3): make_value(rng) for i in range(2000)}
+        stream = io.BytesIO()
+        write_db(stream, self.expected)
+        self.data = stream.getvalue()
+
+    def check(self, db):
+        expected = sorted(self.expected.items())
+        self.assertEqual([(key, as_bytes(value)) for key, value in db.items()], expected)
+        self.assertEqual(list(db.keys()), [key for key, _ in expected])
+        self.assertEqual(list(db.get_all_keys()), [key for key, _ in expected])
+        for key, value in expected[::37]:
+            self.assertEqual(as_bytes(db.get(key)), value)
+        self.assertRaises(KeyError, db.get, make_key(1))
+        # Half of these keys don't exist and must be left out.
+        keys = [make_key(i) for i in range(0, 3000, 7)]
+        values = db.get_many(keys)
+        self.assertEqual({key: as_bytes(value) for key, value in values.items()},
+                         {key: self.expected[key] for key in keys if key in self.expected})
+
+    def test_round_trip(self):
+        db = BTreeDB5(io.BytesIO(self.data))
+        self.check(db)
+        self.assertEqual(db.name, u'Test')
+        self.assertEqual(db.block_size, BLOCK_SIZE)
+        self.assertFalse(db.root_block_is_leaf)
+
+    def test_round_trip_buffer(self):
+        self.check(BTreeDB5(bytearray(self.data)))
+
+    def test_ranges(self):
+        db = BTreeDB5(io.BytesIO(self.data))
+        expected = sorted(self.expected.items())
+        start, end = make_key(300), make_key(1501)
+        self.assertEqual([(key, as_bytes(value)) for key, value in db.items(start, end)],
+                         [(key, value) for key, value in expected if start <= key < end])
+        self.assertEqual(list(db.keys(None, start)), [key for key, _ in expected if key < start])
+        # Keys 0x0100 to 0x01ff all start with these three bytes.
+        prefix = b'\x00\x00\x01'
+        self.assertEqual([(key, as_bytes(value)) for key, value in db.prefix_items(prefix)],
+                         [(key, value) for key, value in expected if key.startswith(prefix)])
+        self.assertEqual(list(db.prefix_keys(b'\xff')), [])
+
+    def test_empty(self):
+        stream = io.BytesIO()
+        write_db(stream, {})
+        db = BTreeDB5(stream)
+        self.assertEqual(list(db.items()), [])
+        self.assertTrue(db.root_block_is_leaf)
+        self.assertEqual(db.get_many([make_key(0)]), {})
+        self.assertRaises(KeyError, db.get, make_key(0))
+
+
+class CommitTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.db')
+        self.rng = random.Random(5678)
+        self.expected = {make_key(i): make_value(self.rng) for i in range(500)}
+        with open(self.path, 'wb') as f:
+            write_db(f, self.expected)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        with open(self.path, 'rb') as f:
+            db = BTreeDB5(f)
+            return self.read_all(db), db.root_block_is_leaf
+
+    def read_all(self, db):
+        return {key: as_bytes(value) for key, value in db.items()}
+
+    def commit(self, changes):
+        with open(self.path, 'r+b') as f:
+            db = BTreeDB5(f)
+            for key, value in changes.items():
+                if value is None:
+                    db.delete(key)
+                else:
+                    db.put(key, value)
+            db.commit()
+            # The same object sees its own changes...
+            self.assertEqual(self.read_all(db), self.expected)
+            # ...and the previous version of the tree is still intact.
+            db.swap_root()
+            previous = self.read_all(db)
+        return previous
+
+    def apply(self, changes):
+        for key, value in changes.items():
+            if value is None:
+                self.expected.pop(key, None)
+            else:
+                self.expected[key] = value
+
+    def test_random_rounds(self):
+        for _ in range(30):
+            changes = {}
+            for _ in range(self.rng.randint(1, 80)):
+                key = make_key(self.rng.randint(0, 1500))
+                if self.rng.random() < .4:
+                    changes[key] = None
+                else:
+                    changes[key] = make_value(self.rng)
+            before = dict(self.expected)
+            self.apply(changes)
+            self.assertEqual(self.commit(changes), before)
+            self.assertEqual(self.reopen()[0], self.expected)
+
+    def test_delete_everything(self):
+        keys = list(self.expected)
+        self.rng.shuffle(keys)
+        # Delete in a few rounds, so that the tree shrinks step by step.
+        for i in range(0, len(keys), 150):
+            changes = {key: None for key in keys[i:i + 150]}
+            before = dict(self.expected)
+            self.apply(changes)
+            self.assertEqual(self.commit(changes), before)
+            self.assertEqual(self.reopen()[0], self.expected)
+        self.assertEqual(self.reopen(), ({}, True))
+        # An empty tree can grow again.
+        changes = {make_key(7): make_value(self.rng, 4 * BLOCK_SIZE), make_key(8): b''}
+        self.apply(changes)
+        self.assertEqual(self.commit(changes), {})
+        self.assertEqual(self.reopen()[0], self.expected)
+
+    def test_multi_block_values(self):
+        changes = {make_key(i): make_value(self.rng, BLOCK_SIZE * (i % 5 + 1) + i)
+                   for i in range(0, 500, 9)}
+        self.apply(changes)
+        self.commit(changes)
+        with open(self.path, 'rb') as f:
+            db = BTreeDB5(f)
+            for key, value in changes.items():
+                self.assertEqual(as_bytes(db.get(key)), value)
+
+    def test_free_blocks_are_reused(self):
+        key = make_key(250)
+        sizes = []
+        for i in range(20):
+            changes = {key: make_value(self.rng, 100 + i)}
+            self.apply(changes)
+            self.commit(changes)
+            sizes.append(os.path.getsize(self.path))
+        # Every commit frees the blocks of the one before it, so the file
+        # stops growing after the first few.
+        self.assertEqual(len(set(sizes[5:])), 1)
+        self.assertEqual(self.reopen()[0], self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
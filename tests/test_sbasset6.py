@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import io
+import mmap
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import unittest
+
+from starbound import sbon
+from starbound.sbasset6 import SBAsset6
+
+
+def write_package(stream, files):
+    stream.write(struct.pack('>8sQ', b'SBAsset6', 0))
+    entries = []
+    for path, data in files:
+        entries.append((path, stream.tell(), len(data)))
+        stream.write(data)
+    metadata_offset = stream.tell()
+    stream.write(b'INDEX')
+    sbon.write_map(stream, {})
+    sbon.write_varint(stream, len(entries))
+    for path, offset, length in entries:
+        sbon.write_string(stream, path)
+        stream.write(struct.pack('>QQ', offset, length))
+    stream.seek(0)
+    stream.write(struct.pack('>8sQ', b'SBAsset6', metadata_offset))
+
+
+class ConcurrentReadTest(unittest.TestCase):
+    NUM_FILES = 3000
+    NUM_THREADS = 8
+
+    @classmethod
+    def setUpClass(cls):
+        rng = random.Random(1234)
+        cls.files = {}
+        for i in range(cls.NUM_FILES):
+            # Every file is different, so a read from the wrong offset shows.
+            data = struct.pack('>I', i) * rng.randint(1, 500)
+            cls.files[u'/files/{}/asset{}.dat'.format(i % 17, i)] = data
+        cls.directory = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.directory, 'test.pak')
+        with open(cls.path, 'wb') as f:
+            write_package(f, sorted(cls.files.items()))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def read_concurrently(self, package, read):
+        package.read_index()
+        paths = sorted(self.files)
+        errors = []
+
+        def worker(seed):
+            order = list(paths)
+            random.Random(seed).shuffle(order)
+            for path in order:
+                data = read(package, path)
+                if isinstance(data, memoryview):
+                    data = data.tobytes()
+                if data != self.files[path]:
+                    errors.append(path)
+
+        threads = [threading.Thread(target=worker, args=(seed,))
+                   for seed in range(self.NUM_THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_file(self):
+        with open(self.path, 'rb') as f:
+            self.read_concurrently(SBAsset6(f), SBAsset6.get)
+
+    def test_file_view(self):
+        with open(self.path, 'rb') as f:
+            self.read_concurrently(SBAsset6(f), SBAsset6.get_view)
+
+    def test_stream_without_fileno(self):
+        with open(self.path, 'rb') as f:
+            stream = io.BytesIO(f.read())
+        self.read_concurrently(SBAsset6(stream), SBAsset6.get)
+
+    def test_mmap(self):
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.read_concurrently(SBAsset6(mm), SBAsset6.get)
+        finally:
+            mm.close()
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio wrappers need Python 3.5+')
+    def test_async_gather(self):
+        import asyncio
+        from starbound.aio import AsyncSBAsset6
+
+        paths = sorted(self.files)
+        with open(self.path, 'rb') as f:
+            package = SBAsset6(f)
+            package.read_index()
+            wrapper = AsyncSBAsset6(package, max_workers=self.NUM_THREADS)
+            # No async syntax here, so that this module still imports on 2.x.
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                reads = asyncio.gather(*[wrapper.get(path) for path in paths])
+                values = loop.run_until_complete(reads)
+            finally:
+                wrapper.close()
+                asyncio.set_event_loop(None)
+                loop.close()
+        wrong = [path for path, value in zip(paths, values) if value != self.files[path]]
+        self.assertEqual(wrong, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import io
+import struct
+import sys
+import unittest
+
+from starbound import sbon
+
+
+if sys.version >= '3':
+    _int_type = int
+    _str_type = str
+
+    def _byte(x):
+        return bytes((x,))
+else:
+    _int_type = (int, long)
+    _str_type = basestring
+
+    def _byte(x):
+        return chr(x)
+
+
+# The stream based writer that `sbon.dumps` replaced, kept here as the
+# reference its output must match byte for byte.
+class ReferenceWriter(object):
+    def __init__(self):
+        self.stream = io.BytesIO()
+
+    def getvalue(self):
+        return self.stream.getvalue()
+
+    def write_dynamic(self, value):
+        if value is None:
+            self.stream.write(b'\x01')
+        elif isinstance(value, float):
+            self.stream.write(b'\x02')
+            self.stream.write(struct.pack('>d', value))
+        elif isinstance(value, bool):
+            self.stream.write(b'\x03\x01' if value else b'\x03\x00')
+        elif isinstance(value, _int_type):
+            self.stream.write(b'\x04')
+            self.write_varint_signed(value)
+        elif isinstance(value, _str_type):
+            self.stream.write(b'\x05')
+            self.write_string(value)
+        elif isinstance(value, list):
+            self.stream.write(b'\x06')
+            self.write_varint(len(value))
+            for v in value:
+                self.write_dynamic(v)
+        elif isinstance(value, dict):
+            self.stream.write(b'\x07')
+            self.write_varint(len(value))
+            for k, v in value.items():
+                self.write_string(k)
+                self.write_dynamic(v)
+        else:
+            raise ValueError('Cannot write value %r' % (value,))
+
+    def write_string(self, value):
+        data = value.encode('utf-8')
+        self.write_varint(len(data))
+        self.stream.write(data)
+
+    def write_varint(self, value):
+        buf = _byte(value & 0b01111111)
+        value >>= 7
+        while value:
+            buf = _byte(value & 0b01111111 | 0b10000000) + buf
+            value >>= 7
+        self.stream.write(buf)
+
+    def write_varint_signed(self, value):
+        self.write_varint((-(value + 1) << 1 | 1) if value < 0 else (value << 1))
+
+
+def reference(method, value):
+    writer = ReferenceWriter()
+    getattr(writer, method)(value)
+    return writer.getvalue()
+
+
+VARINTS = [
+    0, 1, 127, 128, 129, 255, 16383, 16384, 2 ** 21 - 1, 2 ** 21,
+    2 ** 31 - 1, 2 ** 31, 2 ** 32, 2 ** 63 - 1, 2 ** 63, 2 ** 64 - 1,
+    2 ** 64, 2 ** 64 + 1, 2 ** 70 + 12345,
+]
+
+SIGNED_INTS = VARINTS + [
+    -1, -63, -64, -65, -128, -129, -2 ** 31, -2 ** 31 - 1, -2 ** 63,
+    -2 ** 63 - 1, -2 ** 64 - 1,
+]
+
+STRINGS = [
+    u'', u'a', u'x' * 127, u'x' * 128, u'caf\xe9', u'日本語',
+    u'\U0001f680 rocket', u'nul\x00byte', u'\xe9' * 100,
+]
+
+NESTED = {
+    u'name': u'☃ snowman',
+    u'flags': [True, False, 1, 0, None],
+    u'level': {
+        u'empty_map': {},
+        u'empty_list': [],
+        u'numbers': [0, -1, 127, 128, -2 ** 40, 2 ** 65, 1.5, -0.0, 1e300],
+        u'deeper': {u'key %d' % i: {u'index': i, u'odd': bool(i % 2)} for i in range(200)},
+    },
+    u'long list': list(range(300)),
+}
+
+
+class DumpsTest(unittest.TestCase):
+    def assertSameAsReference(self, value):
+        data = sbon.dumps(value)
+        self.assertEqual(data, reference('write_dynamic', value))
+        # The stream based API goes through `dumps` now, so check it too.
+        stream = io.BytesIO()
+        sbon.write_dynamic(stream, value)
+        self.assertEqual(stream.getvalue(), data)
+        self.assertEqual(sbon.loads(data), (value, len(data)))
+
+    def test_varint(self):
+        for value in VARINTS:
+            data = sbon.dumps_varint(value)
+            self.assertEqual(data, reference('write_varint', value), value)
+            stream = io.BytesIO()
+            sbon.write_varint(stream, value)
+            self.assertEqual(stream.getvalue(), data)
+            self.assertEqual(sbon.loads_varint(data), (value, len(data)))
+            self.assertEqual(sbon.read_varint(io.BytesIO(data)), value)
+
+    def test_varint_lengths(self):
+        self.assertEqual(sbon.dumps_varint(127), b'\x7f')
+        self.assertEqual(sbon.dumps_varint(128), b'\x81\x00')
+        self.assertEqual(len(sbon.dumps_varint(2 ** 31)), 5)
+        self.assertEqual(len(sbon.dumps_varint(2 ** 64)), 10)
+
+    def test_signed_int(self):
+        for value in SIGNED_INTS:
+            self.assertSameAsReference(value)
+            stream = io.BytesIO()
+            sbon.write_varint_signed(stream, value)
+            self.assertEqual(stream.getvalue(), reference('write_varint_signed', value))
+            self.assertEqual(sbon.read_varint_signed(io.BytesIO(stream.getvalue())), value)
+
+    def test_bool_is_not_int(self):
+        self.assertEqual(sbon.dumps(True), b'\x03\x01')
+        self.assertEqual(sbon.dumps(False), b'\x03\x00')
+        self.assertEqual(sbon.dumps(1), b'\x04\x02')
+        self.assertEqual(sbon.dumps(0), b'\x04\x00')
+        for value in (True, False, 1, 0, [True, 1, False, 0], {u'a': True, u'b': 1}):
+            self.assertSameAsReference(value)
+        self.assertIs(sbon.loads(sbon.dumps(True))[0], True)
+
+    def test_string(self):
+        for value in STRINGS:
+            self.assertSameAsReference(value)
+            self.assertEqual(sbon.dumps_string(value), reference('write_string', value))
+
+    def test_scalars(self):
+        for value in (None, 0.0, -0.0, 1.5, -2.25, 1e-300, 1e300, float('inf')):
+            self.assertSameAsReference(value)
+
+    def test_nested(self):
+        self.assertSameAsReference(NESTED)
+        self.assertSameAsReference([NESTED, [NESTED], {u'again': NESTED}])
+
+    def test_subclasses(self):
+        class MyDict(dict):
+            pass
+
+        class MyList(list):
+            pass
+
+        value = MyDict(a=MyList([1, 2, MyDict()]))
+        self.assertEqual(sbon.dumps(value), reference('write_dynamic', value))
+
+    def test_invalid_value(self):
+        self.assertRaises(ValueError, sbon.dumps, object())
+        self.assertRaises(ValueError, sbon.dumps, {u'a': (1, 2)})
+
+
+if __name__ == '__main__':
+    unittest.main()